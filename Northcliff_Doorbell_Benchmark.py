@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+# Northcliff Doorbell Monitor Benchmark
+# Runs the doorbell monitor against the simulated GPIO, camera, audio, SIP and mqtt backends and a local Pushover stand-in,
+# scripts ring edges and reports ring-to-handler, ring-to-photo, ring-to-unlock and ring-to-notification latency percentiles.
+# The startup benchmark rings as soon as the monitor has been set up and reports the time to the first ring being handled.
+# The broker outage benchmark rings while the mqtt broker is down and reports the mqtt recovery time and whether those rings were still notified
+import argparse
+import contextlib
+import http.server
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from threading import Thread
+from Northcliff_Doorbell_Monitor_Gen import (NorthcliffDoorbellMonitor, SimulatedGpio, SimulatedCamera, SimulatedAudioPlayer,
+                                             SimulatedCallController, SimulatedMqttBroker)
+
+class PushoverStandIn(object): # The class for a local http server that accepts Pushover messages and records when each one arrives
+    def __init__(self, response_delay = 0):
+        self.response_delay = response_delay
+        self.receive_times = []
+        self.receive_lock = threading.Lock()
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # Keep-alive, as with the Pushover API
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with stand_in.receive_lock:
+                    stand_in.receive_times.append(time.monotonic())
+                time.sleep(stand_in.response_delay)
+                body = b'{"status":1}'
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.api_url = 'http://127.0.0.1:' + str(self.server.server_address[1]) + '/1/messages.json'
+        self.server_thread = Thread(target=self.server.serve_forever, name='pushover_stand_in', daemon=True)
+
+    def start(self):
+        self.server_thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def first_after(self, start_time):
+        with self.receive_lock:
+            later_times = [receive_time for receive_time in self.receive_times if receive_time >= start_time]
+        if len(later_times) == 0:
+            return None
+        return min(later_times)
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(percent / 100 * len(ordered) + 0.5)) - 1)) # Nearest rank
+    return ordered[index]
+
+def summarise(latencies): # Latencies in seconds -> summary in ms
+    if len(latencies) == 0:
+        return {'Count': 0}
+    return {'Count': len(latencies), 'p50': round(percentile(latencies, 50) * 1000, 1), 'p90': round(percentile(latencies, 90) * 1000, 1),
+            'p99': round(percentile(latencies, 99) * 1000, 1), 'Max': round(max(latencies) * 1000, 1)}
+
+def wait_until(condition, timeout):
+    end_time = time.monotonic() + timeout
+    while time.monotonic() < end_time:
+        if condition() == True:
+            return True
+        time.sleep(0.005)
+    return False
+
+def run_benchmark(rings, mode, interrupt_ring_detection = True, frame_rate = 10, message_duration = 0.5, door_open_time = 0.5,
+                  call_duration = 1, pushover_delay = 0, quiet = True):
+    gpio = SimulatedGpio()
+    broker = SimulatedMqttBroker()
+    camera = SimulatedCamera(frame_rate)
+    audio_player = SimulatedAudioPlayer(message_duration)
+    sip_controller = SimulatedCallController(answer_delay = 0.2, call_duration = call_duration)
+    pushover = PushoverStandIn(pushover_delay)
+    pushover.start()
+    capture_directory = tempfile.mkdtemp(prefix='doorbell_benchmark_') + os.sep
+    all_day_windows = {weekday: [('00:00', '00:00')] for weekday in range(7)} # Auto answer is always possible
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log if quiet == True else sys.stdout):
+        monitor = NorthcliffDoorbellMonitor(pushover_in_manual_mode = True, full_video = False, ask_for_auto_time_input = False, active_auto_start = 0,
+                                            active_auto_finish = 0, disable_weekend = False, manual_mode_call_sip_address = 'sip:benchmark@127.0.0.1',
+                                            pushover_token = 'benchmark', pushover_user = 'benchmark', linphone_debug_log_file = os.devnull,
+                                            auto_message_file = 'benchmark.wav', auto_video_capture_directory = capture_directory,
+                                            linphone_config_file = os.devnull, auto_on_startup = False, linphone_in_manual_mode = mode == 'Manual',
+                                            heartbeat_enabled = False, interrupt_ring_detection = interrupt_ring_detection,
+                                            pushover_api_url = pushover.api_url, capture_retention_megabytes = 50, auto_windows = all_day_windows,
+                                            mqtt_broker = 'simulated', door_open_time = door_open_time, gpio = gpio,
+                                            mqtt_client = broker.client('doorbell'), camera = camera, audio_player = audio_player,
+                                            sip_controller = sip_controller)
+        monitor_thread = Thread(target=monitor.run, name='monitor')
+        monitor_thread.start()
+        mqtt_client = monitor.client
+        wait_until(lambda: monitor.state == 'Idle' and len(camera.frames) > 0 and 'DoorbellButton' in mqtt_client.subscriptions, 30)
+        if mode == 'Auto': # Switched by an mqtt command from the Home Manager stand-in
+            broker.publish('DoorbellButton', json.dumps({'service': 'Automatic'}))
+        elif mode == 'Manual': # Switched by a scripted button press
+            gpio.press(monitor.manual_button)
+        if wait_until(lambda: monitor.state == mode, 5) == False:
+            monitor.stop()
+            monitor_thread.join(30)
+            pushover.stop()
+            raise RuntimeError('Monitor did not enter ' + mode + ' mode')
+        handler_latencies = []
+        photo_latencies = []
+        unlock_latencies = []
+        notification_latencies = []
+        try:
+            for ring in range(rings):
+                ring_time = gpio.ring(monitor.door_bell_not_ringing)
+                wait_until(lambda: monitor.ring_sequence != None and monitor.ring_sequence.done() == True and
+                           pushover.first_after(ring_time) != None, 30)
+                if monitor.ring_latency != None and monitor.ring_handler_time >= ring_time: # From the ring edge, so polling's detection delay is included
+                    handler_latencies.append(monitor.ring_handler_time - ring_time)
+                photo_times = [capture_time for capture_time in camera.capture_times if capture_time >= ring_time]
+                if len(photo_times) > 0:
+                    photo_latencies.append(min(photo_times) - ring_time)
+                unlock_times = gpio.output_times(monitor.open_door, True, ring_time)
+                if len(unlock_times) > 0:
+                    unlock_latencies.append(min(unlock_times) - ring_time)
+                notification_time = pushover.first_after(ring_time)
+                if notification_time != None:
+                    notification_latencies.append(notification_time - ring_time)
+                time.sleep(0.35) # Clear of the ring input's bounce time
+        finally:
+            monitor.stop()
+            monitor_thread.join(30)
+            pushover.stop()
+    return {'Mode': mode, 'Rings': rings, 'Ring Detection': 'Interrupt' if interrupt_ring_detection == True else 'Polling',
+            'Ring To Handler': summarise(handler_latencies), 'Ring To Photo': summarise(photo_latencies), 'Ring To Unlock': summarise(unlock_latencies),
+            'Ring To Notification': summarise(notification_latencies)}
+
+def run_startup_benchmark(runs, fast_start, mqtt_connect_delay = 1, camera_warm_up_time = 1.5, linphone_start_delay = 2, test_call_answer_delay = 2,
+                          test_call_duration = 5, out_of_hours = False, quiet = True): # Out of hours, auto on startup falls back to manual answer, which
+    # also uses Linphone
+    handled_latencies = []
+    photo_latencies = []
+    unlock_latencies = []
+    notification_latencies = []
+    readiness = {}
+    linphone_starts = []
+    if out_of_hours == True:
+        auto_windows = {} # Auto answer is never possible
+    else:
+        auto_windows = {weekday: [('00:00', '00:00')] for weekday in range(7)} # Auto answer is always possible
+    for run in range(runs):
+        gpio = SimulatedGpio()
+        broker = SimulatedMqttBroker(connect_delay = mqtt_connect_delay)
+        camera = SimulatedCamera(warm_up_time = camera_warm_up_time)
+        sip_controller = SimulatedCallController(answer_delay = test_call_answer_delay, call_duration = test_call_duration, start_delay = linphone_start_delay)
+        pushover = PushoverStandIn()
+        pushover.start()
+        capture_directory = tempfile.mkdtemp(prefix='doorbell_startup_benchmark_') + os.sep
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log if quiet == True else sys.stdout):
+            start_time = time.monotonic()
+            monitor = NorthcliffDoorbellMonitor(pushover_in_manual_mode = True, full_video = False, ask_for_auto_time_input = False, active_auto_start = 0,
+                                                active_auto_finish = 0, disable_weekend = False, manual_mode_call_sip_address = 'sip:benchmark@127.0.0.1',
+                                                pushover_token = 'benchmark', pushover_user = 'benchmark', linphone_debug_log_file = os.devnull,
+                                                auto_message_file = 'benchmark.wav', auto_video_capture_directory = capture_directory,
+                                                linphone_config_file = os.devnull, auto_on_startup = True, linphone_in_manual_mode = True,
+                                                heartbeat_enabled = False, pushover_api_url = pushover.api_url, auto_windows = auto_windows,
+                                                mqtt_broker = 'simulated', door_open_time = 0.5, gpio = gpio, mqtt_client = broker.client('doorbell'),
+                                                camera = camera, audio_player = SimulatedAudioPlayer(0.5), sip_controller = sip_controller,
+                                                fast_start = fast_start)
+            monitor_thread = Thread(target=monitor.run, name='monitor')
+            monitor_thread.start()
+            ring_time = gpio.ring(monitor.door_bell_not_ringing) # The first ring that the monitor could detect
+            try:
+                wait_until(lambda: monitor.ring_sequence != None and monitor.ring_sequence.done() == True and
+                           pushover.first_after(ring_time) != None, 120)
+                wait_until(lambda: len(monitor.readiness) >= 7, 60) # Ring Detection, Door Control, mqtt, Camera, Audio, Linphone and SIP Self Test
+                if monitor.ring_latency != None:
+                    handled_latencies.append(ring_time + monitor.ring_latency - start_time)
+                photo_times = [capture_time for capture_time in camera.capture_times if capture_time >= ring_time]
+                if len(photo_times) > 0:
+                    photo_latencies.append(min(photo_times) - start_time)
+                unlock_times = gpio.output_times(monitor.open_door, True, ring_time)
+                if len(unlock_times) > 0:
+                    unlock_latencies.append(min(unlock_times) - start_time)
+                notification_time = pushover.first_after(ring_time)
+                if notification_time != None:
+                    notification_latencies.append(notification_time - start_time)
+                for component, (ready, seconds) in dict(monitor.readiness).items():
+                    if ready == True:
+                        readiness.setdefault(component, []).append(seconds)
+            finally:
+                monitor.stop()
+                monitor_thread.join(60)
+                pushover.stop()
+            linphone_starts.append(sip_controller.process_starts)
+    mode = 'Fast Start' if fast_start == True else 'Normal Start'
+    if out_of_hours == True:
+        mode += ' Out Of Hours'
+    return {'Mode': mode, 'Runs': runs, 'Linphone Starts': max(linphone_starts),
+            'Simulated Delays': {'mqtt Connect': mqtt_connect_delay, 'Camera Warm Up': camera_warm_up_time, 'Linphone Start': linphone_start_delay,
+                                 'Test Call': test_call_answer_delay + test_call_duration},
+            'Startup To Ring Handled': summarise(handled_latencies), 'Startup To Photo': summarise(photo_latencies),
+            'Startup To Unlock': summarise(unlock_latencies), 'Startup To Notification': summarise(notification_latencies),
+            'Ready': {component: summarise(seconds) for component, seconds in readiness.items()}}
+
+def run_outage_benchmark(outage_seconds, rings = 3, mqtt_reconnect_max_delay = 30, quiet = True): # Rings are spread across the outage
+    gpio = SimulatedGpio()
+    broker = SimulatedMqttBroker()
+    camera = SimulatedCamera()
+    pushover = PushoverStandIn()
+    pushover.start()
+    home_manager = broker.client('home_manager') # Records the ringing pulses that reach Home Manager
+    ringing_times = []
+
+    def record_ringing(client, userdata, msg):
+        if json.loads(msg.payload).get('Ringing') == True:
+            ringing_times.append(time.monotonic())
+
+    home_manager.on_message = record_ringing
+    home_manager.connect('simulated')
+    home_manager.loop_start()
+    home_manager.subscribe('DoorbellStatus')
+    capture_directory = tempfile.mkdtemp(prefix='doorbell_outage_benchmark_') + os.sep
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log if quiet == True else sys.stdout):
+        monitor = NorthcliffDoorbellMonitor(pushover_in_manual_mode = True, full_video = False, ask_for_auto_time_input = False, active_auto_start = 0,
+                                            active_auto_finish = 0, disable_weekend = False, manual_mode_call_sip_address = 'sip:benchmark@127.0.0.1',
+                                            pushover_token = 'benchmark', pushover_user = 'benchmark', linphone_debug_log_file = os.devnull,
+                                            auto_message_file = 'benchmark.wav', auto_video_capture_directory = capture_directory,
+                                            linphone_config_file = os.devnull, auto_on_startup = False, linphone_in_manual_mode = False,
+                                            heartbeat_enabled = False, pushover_api_url = pushover.api_url, mqtt_broker = 'simulated', gpio = gpio,
+                                            mqtt_client = broker.client('doorbell'), camera = camera, audio_player = SimulatedAudioPlayer(0.5),
+                                            sip_controller = SimulatedCallController(), mqtt_reconnect_max_delay = mqtt_reconnect_max_delay)
+        monitor_thread = Thread(target=monitor.run, name='monitor')
+        monitor_thread.start()
+        supervisor = monitor.services.supervisor
+        notification_latencies = []
+        try:
+            wait_until(lambda: monitor.state == 'Idle' and len(camera.frames) > 0 and 'DoorbellButton' in monitor.client.subscriptions, 30)
+            outage_start = time.monotonic()
+            broker.stop()
+            ring_times = []
+            for ring in range(rings):
+                time.sleep(outage_seconds / (rings + 1))
+                ring_times.append(gpio.ring(monitor.door_bell_not_ringing))
+            time.sleep(max(outage_start + outage_seconds - time.monotonic(), 0))
+            broker.start()
+            broker_back = time.monotonic()
+            reconnected = wait_until(lambda: supervisor.disconnected_time == None, max(mqtt_reconnect_max_delay * 2, 30))
+            reconnection_time = time.monotonic() - broker_back
+            wait_until(lambda: len(pushover.receive_times) >= rings, 30)
+            time.sleep(0.5) # Any ringing pulses queued while disconnected
+            for index, ring_time in enumerate(ring_times):
+                next_ring_time = ring_times[index + 1] if index + 1 < len(ring_times) else None
+                notification_time = pushover.first_after(ring_time)
+                if notification_time != None and (next_ring_time == None or notification_time < next_ring_time):
+                    notification_latencies.append(notification_time - ring_time)
+            recovery_histogram = monitor.services.metrics.histograms.get(('doorbell_mqtt_recovery_seconds', ()))
+        finally:
+            monitor.stop()
+            monitor_thread.join(30)
+            home_manager.loop_stop()
+            pushover.stop()
+    ringing_delivered = len([ringing_time for ringing_time in ringing_times if ringing_time >= outage_start])
+    return {'Outage Seconds': outage_seconds, 'mqtt Reconnect Max Delay': mqtt_reconnect_max_delay, 'Rings During Outage': rings,
+            'Rings Notified': len(notification_latencies), 'Ringing Reached Home Manager': ringing_delivered,
+            'Reconnected': reconnected, 'Reconnected After Broker Back Seconds': round(reconnection_time, 2) if reconnected == True else None,
+            'doorbell_mqtt_recovery_seconds': round(recovery_histogram['Max'], 2) if recovery_histogram != None else None,
+            'Ring To Notification': summarise(notification_latencies)}
+
+def print_outage_results(results):
+    print('mqtt broker outage of ' + str(results['Outage Seconds']) + ' seconds, ' + str(results['Rings During Outage']) + ' rings during the outage')
+    print('Rings notified by Pushover: ' + str(results['Rings Notified']) + ' of ' + str(results['Rings During Outage']))
+    print('Ringing pulses that reached Home Manager: ' + str(results['Ringing Reached Home Manager']))
+    if results['Reconnected'] == True:
+        print('doorbell_mqtt_recovery_seconds: ' + str(results['doorbell_mqtt_recovery_seconds']) + ' (' +
+              str(results['Reconnected After Broker Back Seconds']) + ' after the broker came back)')
+    else:
+        print('mqtt connection not restored')
+    summary = results['Ring To Notification']
+    print('%-22s %6s %9s %9s %9s %9s' % ('Latency (ms)', 'Count', 'p50', 'p90', 'p99', 'Max'))
+    if summary['Count'] == 0:
+        print('%-22s %6d %9s %9s %9s %9s' % ('Ring To Notification', 0, '-', '-', '-', '-'))
+    else:
+        print('%-22s %6d %9.1f %9.1f %9.1f %9.1f' % ('Ring To Notification', summary['Count'], summary['p50'], summary['p90'], summary['p99'], summary['Max']))
+
+def print_startup_results(results):
+    print(results['Mode'] + ', ' + str(results['Runs']) + ' runs, ringing as soon as the monitor has been set up. Linphone started at most ' +
+          str(results['Linphone Starts']) + ' times per run')
+    print('%-26s %6s %9s %9s %9s %9s' % ('Time after startup (ms)', 'Count', 'p50', 'p90', 'p99', 'Max'))
+    measures = [(measure, results[measure]) for measure in ('Startup To Ring Handled', 'Startup To Photo', 'Startup To Unlock', 'Startup To Notification')]
+    measures += [(component + ' Ready', summary) for component, summary in results['Ready'].items()]
+    for measure, summary in measures:
+        if summary['Count'] == 0:
+            print('%-26s %6d %9s %9s %9s %9s' % (measure, 0, '-', '-', '-', '-'))
+        else:
+            print('%-26s %6d %9.1f %9.1f %9.1f %9.1f' % (measure, summary['Count'], summary['p50'], summary['p90'], summary['p99'], summary['Max']))
+
+def print_results(results):
+    print(results['Mode'] + ' mode, ' + str(results['Rings']) + ' rings, ' + results['Ring Detection'] + ' ring detection')
+    print('%-22s %6s %9s %9s %9s %9s' % ('Latency (ms)', 'Count', 'p50', 'p90', 'p99', 'Max'))
+    for measure in ('Ring To Handler', 'Ring To Photo', 'Ring To Unlock', 'Ring To Notification'):
+        summary = results[measure]
+        if summary['Count'] == 0:
+            print('%-22s %6d %9s %9s %9s %9s' % (measure, 0, '-', '-', '-', '-'))
+        else:
+            print('%-22s %6d %9.1f %9.1f %9.1f %9.1f' % (measure, summary['Count'], summary['p50'], summary['p90'], summary['p99'], summary['Max']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Doorbell monitor ring latency benchmark using simulated hardware')
+    parser.add_argument('--rings', type=int, default=20)
+    parser.add_argument('--mode', choices=['Idle', 'Auto', 'Manual', 'All'], default='All')
+    parser.add_argument('--polling', action='store_true', help='Use polling rather than interrupt ring detection')
+    parser.add_argument('--pushover-delay', type=float, default=0, help='Pushover stand-in response delay in seconds')
+    parser.add_argument('--json', help='Also write the results to this file, e.g. for CI')
+    parser.add_argument('--verbose', action='store_true', help='Show the monitor output')
+    parser.add_argument('--startup', action='store_true', help='Run the time to first ring handled startup benchmark, with and without fast start')
+    parser.add_argument('--startup-runs', type=int, default=3)
+    parser.add_argument('--broker-outage', type=float, metavar='SECONDS', help='Ring while the mqtt broker is down for this many seconds')
+    parser.add_argument('--outage-rings', type=int, default=3)
+    arguments = parser.parse_args()
+    if arguments.broker_outage != None:
+        results = run_outage_benchmark(arguments.broker_outage, arguments.outage_rings, quiet = not arguments.verbose)
+        print_outage_results(results)
+        if arguments.json != None:
+            with open(arguments.json, 'w') as results_file:
+                json.dump(results, results_file, indent=2)
+        sys.exit(0)
+    if arguments.startup == True:
+        all_results = []
+        for out_of_hours in (False, True):
+            for fast_start in (False, True):
+                results = run_startup_benchmark(arguments.startup_runs, fast_start, out_of_hours = out_of_hours, quiet = not arguments.verbose)
+                print_startup_results(results)
+                all_results.append(results)
+        if arguments.json != None:
+            with open(arguments.json, 'w') as results_file:
+                json.dump(all_results, results_file, indent=2)
+        sys.exit(0)
+    if arguments.mode == 'All':
+        modes = ['Idle', 'Auto', 'Manual']
+    else:
+        modes = [arguments.mode]
+    all_results = []
+    for mode in modes:
+        results = run_benchmark(arguments.rings, mode, interrupt_ring_detection = not arguments.polling,
+                                pushover_delay = arguments.pushover_delay, quiet = not arguments.verbose)
+        print_results(results)
+        all_results.append(results)
+    if arguments.json != None:
+        with open(arguments.json, 'w') as results_file:
+            json.dump(all_results, results_file, indent=2)
@@ -1,93 +1,2321 @@
 #!/usr/bin/env python3
 # Northcliff Doorbell Monitor Version 2.6 GEN
 # Requires Home Manager >= V8.5
-import RPi.GPIO as GPIO
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
+import bisect
 import subprocess
-import http.client
-import urllib
 import mmap
 import requests
-from threading import Thread
+import threading
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor, Future
+import queue
 import paho.mqtt.client as mqtt
 import struct
 import json
 import os
+import collections
+import contextlib
+import http.server
+import sqlite3
+import io
+import wave
+try:
+    import cv2 # Only required for the buffered camera
+except ImportError:
+    cv2 = None
+try:
+    import alsaaudio # Only required for playing messages without spawning aplay
+except ImportError:
+    alsaaudio = None
+try:
+    from PIL import Image # Only required for downscaling Pushover attachments. Metadata is still stripped without it
+except ImportError:
+    Image = None
 
-class TwoLedFlash(object): # The class for the LED flashing thread
-    def __init__(self, cycle_duration, cycle_count):
-        self.cycle_duration = cycle_duration
-        self.cycle_count = cycle_count
-        # Set up the LED GPIO ports
-        self.auto_led_off = 21
-        self.manual_led_off = 27
-        GPIO.setup(self.auto_led_off, GPIO.OUT)
-        GPIO.setup(self.manual_led_off, GPIO.OUT)
-        # Turn off both LEDs
-        GPIO.output(self.manual_led_off, True)
-        self.manual_led_state = False
-        GPIO.output(self.auto_led_off, True)
-        self.auto_led_state = False
-        self.manual_led_on_count = 10 # LED flashing during startup
-        self.auto_led_on_count = 10 # LED flashing during startup
-        self.flash_enable = True # Allows LED flashing to proceed upon startup
-        self.led_counter = 0 # Reset LED Counter upon startup
-        
-    def terminate(self): # Stops the LED flashing loop upon shutdown
-        self.flash_enable = False
-        
-    def run(self): # The LED flashing method
-        while self.flash_enable == True: # LED flashing loop continues until shut down
-            if self.led_counter < self.cycle_count: # led_cycle count sets the number of loops per cycle
-                if self.led_counter >= self.manual_led_on_count:
-                    GPIO.output(self.manual_led_off, True)
-                    self.manual_led_state = False
+def raspberry_pi_gpio(): # Imported when the monitor is set up, so that the monitor can be run off the Pi with a simulated GPIO backend
+    import RPi.GPIO
+    return RPi.GPIO
+
+class SimulatedGpio(object): # The class for simulating the subset of the RPi.GPIO interface that the monitor uses
+    BCM = 'BCM'
+    IN = 'IN'
+    OUT = 'OUT'
+    PUD_UP = 'PUD_UP'
+    PUD_DOWN = 'PUD_DOWN'
+    RISING = 'RISING'
+    FALLING = 'FALLING'
+    BOTH = 'BOTH'
+
+    def __init__(self):
+        self.gpio_lock = Lock()
+        self.levels = {}
+        self.event_detectors = {} # pin: (edge, callback, bounce time in seconds, last callback time)
+        self.output_log = collections.deque(maxlen=10000) # (time, pin, level) for each output write
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, warnings):
+        pass
+
+    def setup(self, pin, direction, pull_up_down = None):
+        with self.gpio_lock:
+            if direction == self.OUT or pull_up_down == self.PUD_DOWN:
+                self.levels[pin] = False
+            else:
+                self.levels[pin] = True # Inputs without a pull down rest high, e.g. the doorbell not ringing input
+
+    def input(self, pin):
+        with self.gpio_lock:
+            return self.levels.get(pin, False)
+
+    def output(self, pin, level):
+        with self.gpio_lock:
+            self.levels[pin] = bool(level)
+            self.output_log.append((time.monotonic(), pin, bool(level)))
+
+    def add_event_detect(self, pin, edge, callback = None, bouncetime = 0):
+        with self.gpio_lock:
+            self.event_detectors[pin] = (edge, callback, bouncetime / 1000, None)
+
+    def remove_event_detect(self, pin):
+        with self.gpio_lock:
+            self.event_detectors.pop(pin, None)
+
+    def cleanup(self, channels = None): # As with RPi.GPIO, only the listed channels are cleaned up if they're given
+        with self.gpio_lock:
+            if channels == None:
+                self.event_detectors.clear()
+            else:
+                for channel in channels:
+                    self.event_detectors.pop(channel, None)
+
+    def set_input(self, pin, level): # Drives an input. Returns the time of the change. Edge callbacks run on their own thread, as with RPi.GPIO
+        level = bool(level)
+        with self.gpio_lock:
+            edge_time = time.monotonic()
+            previous_level = self.levels.get(pin, False)
+            self.levels[pin] = level
+            callback = None
+            if pin in self.event_detectors and previous_level != level:
+                edge, callback, bounce_time, last_callback_time = self.event_detectors[pin]
+                edge_matches = edge == self.BOTH or (edge == self.RISING) == level
+                debounced = last_callback_time == None or edge_time - last_callback_time >= bounce_time
+                if callback != None and edge_matches == True and debounced == True:
+                    self.event_detectors[pin] = (edge, callback, bounce_time, edge_time)
                 else:
-                    GPIO.output(self.manual_led_off, False)
-                    self.manual_led_state = True
-                if self.led_counter >= self.auto_led_on_count:
-                    GPIO.output(self.auto_led_off, True)
-                    self.auto_led_state = False
+                    callback = None
+        if callback != None:
+            Thread(target=callback, args=(pin,), name='gpio_callback', daemon=True).start()
+        return edge_time
+
+    def press(self, pin, duration = 0.05): # Simulates a button press on a pulled down input
+        press_time = self.set_input(pin, True)
+        time.sleep(duration)
+        self.set_input(pin, False)
+        return press_time
+
+    def ring(self, pin, duration = 0.2): # Simulates the doorbell ringing on the active low doorbell not ringing input
+        ring_time = self.set_input(pin, False)
+        time.sleep(duration)
+        self.set_input(pin, True)
+        return ring_time
+
+    def output_times(self, pin, level, after = 0): # Returns the times that the output was written with the level
+        with self.gpio_lock:
+            return [output_time for output_time, output_pin, output_level in self.output_log if output_pin == pin and output_level == level and output_time >= after]
+
+class LedPatternDriver(object): # The class for the LED thread. Only the LED edges are scheduled and the thread sleeps while the LEDs are steady
+    led_patterns = {'Off': (0, 1), 'On': (1, 1), 'Flash': (0.5, 1), 'Blip': (0.05, 1)} # (on time, cycle period) in seconds
+
+    def __init__(self, gpio, manual_led_pin = 27, auto_led_pin = 21):
+        # Set up the LED GPIO ports. The LEDs are on when their ports are low
+        self.gpio = gpio
+        self.led_pins = {'Manual': manual_led_pin, 'Auto': auto_led_pin}
+        self.led_states = {}
+        for led, pin in self.led_pins.items():
+            self.gpio.setup(pin, self.gpio.OUT)
+            self.gpio.output(pin, True) # Turn off both LEDs
+            self.led_states[led] = False
+        self.patterns = {'Manual': 'Flash', 'Auto': 'Flash'} # LED flashing during startup
+        self.pattern_changed = threading.Condition()
+        self.cycle_start = time.monotonic()
+        self.led_enable = True # Allows LED flashing to proceed upon startup
+        self.wakeups = 0
+        self.gpio_writes = 0
+        self.metrics_start = time.monotonic()
+
+    def set_patterns(self, manual_pattern = None, auto_pattern = None): # Thread safe. None leaves that LED's pattern unchanged. Restarts the flash cycle
+        with self.pattern_changed:
+            if manual_pattern != None:
+                self.patterns['Manual'] = manual_pattern
+            if auto_pattern != None:
+                self.patterns['Auto'] = auto_pattern
+            self.cycle_start = time.monotonic()
+            self.pattern_changed.notify()
+
+    def terminate(self): # Stops the LED thread upon shutdown
+        with self.pattern_changed:
+            self.led_enable = False
+            self.pattern_changed.notify()
+
+    def led_on(self, pattern, cycle_time):
+        on_time, period = self.led_patterns[pattern]
+        return cycle_time % period < on_time
+
+    def time_to_next_edge(self, pattern, cycle_time): # Returns None if the LED is steady
+        on_time, period = self.led_patterns[pattern]
+        if on_time <= 0 or on_time >= period:
+            return None
+        phase = cycle_time % period
+        if phase < on_time:
+            return on_time - phase
+        return period - phase
+
+    def run(self): # The LED driving method
+        with self.pattern_changed:
+            while self.led_enable == True:
+                self.wakeups += 1
+                cycle_time = time.monotonic() - self.cycle_start + 0.001 # Allows for the wait returning fractionally before the edge
+                timeout = None
+                for led, pattern in self.patterns.items():
+                    led_state = self.led_on(pattern, cycle_time)
+                    if led_state != self.led_states[led]: # Only the edges are written
+                        self.gpio.output(self.led_pins[led], not led_state)
+                        self.led_states[led] = led_state
+                        self.gpio_writes += 1
+                    edge_time = self.time_to_next_edge(pattern, cycle_time)
+                    if edge_time != None and (timeout == None or edge_time < timeout):
+                        timeout = edge_time
+                self.pattern_changed.wait(timeout) # Sleeps until the next edge or pattern change
+
+    def wakeup_metrics(self): # Returns the wakeups and GPIO writes per second since the LEDs were set up. Reading doesn't reset the counts, so the
+        # metrics can be scraped and published as well as printed at shutdown
+        with self.pattern_changed:
+            elapsed_time = time.monotonic() - self.metrics_start
+            return {'Wakeups Per Second': self.wakeups / elapsed_time, 'GPIO Writes Per Second': self.gpio_writes / elapsed_time}
+
+class PushoverNotifier(object): # The class for the Pushover notification thread
+    def __init__(self, token, user, api_url = "https://api.pushover.net/1/messages.json", queue_size = 20, max_attempts = 4, retry_delay = 2,
+                 request_timeout = 30, attachment_processor = None):
+        self.token = token
+        self.user = user
+        self.api_url = api_url
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay # Initial retry delay in seconds. Doubles on each retry
+        self.request_timeout = request_timeout
+        # A single session keeps the TLS connection to Pushover alive between notifications
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.send_queue = queue.Queue(maxsize=queue_size) # Bounded so that a Pushover outage can't exhaust memory
+        self.metrics_lock = Lock()
+        self.metrics = {'Queued': 0, 'Sent': 0, 'Failed': 0, 'Retries': 0, 'Dropped': 0, 'Total Latency': 0.0, 'Last Latency': None, 'Upload Bytes': 0}
+        self.notifier_thread = None
+        self.start_lock = Lock() # Stations sharing the notifier may each ask their watchdog to restart it
+        self.attachment_processor = attachment_processor # Prepares pictures for upload while the message waits in the queue. None uploads the original
+        self.notify_enable = True
+
+    def start(self):
+        with self.start_lock:
+            if self.is_alive() == True:
+                return
+            self.notifier_thread = Thread(target=self.run, name='pushover', daemon=True)
+            self.notifier_thread.start()
+
+    def is_alive(self):
+        return self.notifier_thread != None and self.notifier_thread.is_alive()
+
+    def terminate(self): # Stops the notification thread once the queued messages have been sent
+        self.notify_enable = False
+        try:
+            self.send_queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def send_message(self, pushed_message, alert_sound, picture_file_name = None, title = "Doorbell"): # Queues a message and returns a future for its delivery result
+        delivery = Future()
+        attachment = None
+        if picture_file_name != None and self.attachment_processor != None:
+            attachment = self.attachment_processor.prepare(picture_file_name)
+        try:
+            self.send_queue.put_nowait((pushed_message, alert_sound, picture_file_name, attachment, title, delivery, time.monotonic()))
+            self.count('Queued')
+        except queue.Full:
+            print("Pushover queue full. Message dropped: " + pushed_message)
+            self.count('Dropped')
+            delivery.set_result(False)
+        return delivery
+
+    def count(self, metric, increment = 1):
+        with self.metrics_lock:
+            self.metrics[metric] += increment
+
+    def delivery_metrics(self):
+        with self.metrics_lock:
+            metrics = dict(self.metrics)
+        if metrics['Sent'] > 0:
+            metrics['Average Latency'] = metrics['Total Latency'] / metrics['Sent']
+        else:
+            metrics['Average Latency'] = None
+        metrics['Queue Depth'] = self.send_queue.qsize()
+        return metrics
+
+    def run(self): # The notification sending method
+        while True:
+            queued_message = self.send_queue.get()
+            if queued_message == None:
+                break
+            pushed_message, alert_sound, picture_file_name, attachment, title, delivery, queued_time = queued_message
+            delivered = self.deliver(pushed_message, alert_sound, picture_file_name, attachment, title)
+            delivery.set_result(delivered)
+            if self.notify_enable == False and self.send_queue.empty():
+                break
+        self.session.close()
+
+    def deliver(self, pushed_message, alert_sound, picture_file_name, attachment = None, title = "Doorbell"): # Sends a message, retrying with backoff on connection errors and server errors
+        retry_delay = self.retry_delay
+        for attempt in range(1, self.max_attempts + 1):
+            send_start = time.monotonic()
+            try:
+                status_code = self.post(pushed_message, alert_sound, picture_file_name, attachment, title)
+            except (requests.RequestException, OSError) as error:
+                status_code = None
+                print("Pushover send failed with " + repr(error))
+            send_latency = time.monotonic() - send_start
+            if status_code != None and status_code < 400:
+                with self.metrics_lock:
+                    self.metrics['Sent'] += 1
+                    self.metrics['Total Latency'] += send_latency
+                    self.metrics['Last Latency'] = send_latency
+                print("Pushover message sent in " + str(round(send_latency * 1000)) + " ms on attempt " + str(attempt))
+                return True
+            if status_code != None and status_code < 500 and status_code != 429: # Pushover rejected the message, so retrying won't help
+                print("Pushover message rejected with status " + str(status_code))
+                break
+            if attempt < self.max_attempts:
+                self.count('Retries')
+                time.sleep(retry_delay)
+                retry_delay *= 2
+        self.count('Failed')
+        return False
+
+    def post(self, pushed_message, alert_sound, picture_file_name, attachment = None, title = "Doorbell"):
+        data = {"token": self.token, "user": self.user, "title": title, "message": pushed_message, "sound": alert_sound}
+        if picture_file_name == None: # No picture is to be pushed
+            data["html"] = "1"
+            response = self.session.post(self.api_url, data = data, timeout = self.request_timeout)
+        else: # Picture is to be pushed
+            picture = self.attachment_bytes(picture_file_name, attachment)
+            self.count('Upload Bytes', len(picture))
+            response = self.session.post(self.api_url, data = data, timeout = self.request_timeout,
+                                         files = {"attachment": ("image.jpg", picture, "image/jpeg")})
+        response.close() # Returns the connection to the pool
+        return response.status_code
+
+    def attachment_bytes(self, picture_file_name, attachment): # The prepared attachment or, if it couldn't be prepared, the original picture
+        if attachment != None:
+            try:
+                return attachment.result(self.request_timeout)
+            except Exception as error:
+                print("Attachment preparation failed with " + repr(error) + ". Sending the original picture")
+        with open(picture_file_name, "rb") as picture_file:
+            return picture_file.read()
+
+class AttachmentProcessor(object): # The class for preparing downscaled, size-capped Pushover attachments on a background thread
+    def __init__(self, max_dimension = 1024, max_bytes = 150000, quality = 75, cache_size = 8):
+        self.max_dimension = max_dimension # Longest side in pixels. None only strips the metadata
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict() # (path, modified time, size): future for the attachment bytes, least recently used first
+        self.cache_lock = Lock()
+        self.metrics = {'Processed': 0, 'Cache Hits': 0, 'Original Bytes': 0, 'Attachment Bytes': 0, 'Total Processing Time': 0.0}
+        self.processing_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='attachment')
+
+    def terminate(self):
+        self.processing_executor.shutdown(wait=False)
+
+    def prepare(self, picture_file_name): # Returns a future for the attachment bytes. Processing starts straight away on the attachment thread
+        try:
+            file_stat = os.stat(picture_file_name)
+        except OSError as error:
+            attachment = Future()
+            attachment.set_exception(error)
+            return attachment
+        cache_key = (picture_file_name, file_stat.st_mtime_ns, file_stat.st_size) # A rewritten capture isn't served from the cache
+        with self.cache_lock:
+            if cache_key in self.cache:
+                self.cache.move_to_end(cache_key)
+                self.metrics['Cache Hits'] += 1
+                return self.cache[cache_key]
+            attachment = self.processing_executor.submit(self.process, picture_file_name)
+            self.cache[cache_key] = attachment
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return attachment
+
+    def process(self, picture_file_name):
+        start = time.monotonic()
+        with open(picture_file_name, 'rb') as picture_file:
+            original = picture_file.read()
+        attachment = self.strip_metadata(original)
+        if Image != None and self.max_dimension != None:
+            try:
+                downscaled = self.downscale(original)
+                if len(downscaled) < len(attachment):
+                    attachment = downscaled
+            except (OSError, ValueError) as error: # The picture can't be decoded, so the stripped original is sent
+                print("Unable to downscale " + picture_file_name + ": " + repr(error))
+        with self.cache_lock:
+            self.metrics['Processed'] += 1
+            self.metrics['Original Bytes'] += len(original)
+            self.metrics['Attachment Bytes'] += len(attachment)
+            self.metrics['Total Processing Time'] += time.monotonic() - start
+        return attachment
+
+    def downscale(self, original): # Reduces the quality and then the size until the attachment is within max_bytes
+        source_image = Image.open(io.BytesIO(original))
+        source_image.draft('RGB', (self.max_dimension, self.max_dimension)) # Decodes the JPEG at a reduced scale, which is much faster on the Pi
+        image = source_image.convert('RGB')
+        source_image.close()
+        image.thumbnail((self.max_dimension, self.max_dimension))
+        quality = self.quality
+        while True:
+            output = io.BytesIO()
+            image.save(output, 'JPEG', quality = quality, optimize = True) # EXIF and other metadata aren't copied
+            if self.max_bytes == None or output.tell() <= self.max_bytes or max(image.size) <= 320:
+                return output.getvalue()
+            if quality > 45:
+                quality -= 15
+            else:
+                image.thumbnail((max(image.size) * 3 // 4, max(image.size) * 3 // 4))
+
+    @staticmethod
+    def strip_metadata(original): # Removes the APP1 to APP13, APP15 and comment segments, e.g. EXIF and thumbnails, from a JPEG
+        if original[:2] != b'\xff\xd8':
+            return original
+        stripped = [original[:2]]
+        position = 2
+        while position + 4 <= len(original):
+            if original[position] != 0xFF:
+                return original # Not a segment marker, so the JPEG isn't understood
+            marker = original[position + 1]
+            if marker == 0xFF: # Fill byte
+                position += 1
+                continue
+            if marker == 0xDA: # Start of scan. The compressed image data follows
+                stripped.append(original[position:])
+                return b''.join(stripped)
+            segment_length = struct.unpack('>H', original[position + 2:position + 4])[0]
+            segment_end = position + 2 + segment_length
+            if segment_end > len(original):
+                return original # Truncated
+            if (0xE1 <= marker <= 0xED or marker in (0xEF, 0xFE)) == False:
+                stripped.append(original[position:segment_end])
+            position = segment_end
+        stripped.append(original[position:])
+        return b''.join(stripped)
+
+    def processing_metrics(self):
+        with self.cache_lock:
+            metrics = dict(self.metrics)
+        if metrics['Processed'] > 0:
+            metrics['Average Processing Time'] = metrics['Total Processing Time'] / metrics['Processed']
+        else:
+            metrics['Average Processing Time'] = None
+        return metrics
+
+class FswebcamCamera(object): # The class for capturing pictures by running fswebcam for each capture
+    def __init__(self, capture_delay = 2.5):
+        self.capture_delay = capture_delay # Delay after the ring before the picture is taken
+
+    def start(self):
+        pass
+
+    def is_alive(self): # There's no camera thread
+        return True
+
+    def wait_for_frame(self, timeout = 10): # fswebcam opens the device for each capture, so there's nothing to warm up
+        return True
+
+    def pause(self):
+        pass
+
+    def resume(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def capture(self, picture_file_name, ring_time = None):
+        if ring_time != None:
+            delay = ring_time + self.capture_delay - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return subprocess.call(["fswebcam " + picture_file_name], shell=True) == 0
+
+class OpenCvFrameSource(object): # The class for reading frames from a video device that is kept open. Frames are only JPEG encoded as they're read when
+    # they're all needed for clips. Otherwise the raw frames are buffered and only the captured frame is encoded
+    def __init__(self, device = 0, jpeg_quality = 90, frame_rate = 10, encode_frames = False):
+        self.device = device
+        self.jpeg_quality = jpeg_quality
+        self.frame_period = 1 / frame_rate
+        self.encode_frames = encode_frames
+        self.video_capture = None
+        self.next_frame_time = None
+
+    def open(self):
+        self.video_capture = cv2.VideoCapture(self.device)
+        self.video_capture.set(cv2.CAP_PROP_FPS, 1 / self.frame_period)
+        self.next_frame_time = time.monotonic()
+        return self.video_capture.isOpened()
+
+    def read_frame(self): # Returns the next frame or None if the device can't be read. Frames beyond the frame rate, e.g. if the device ignores the
+        # frame rate setting, are grabbed and dropped without being decoded
+        while True:
+            if self.video_capture.grab() == False:
+                return None
+            frame_time = time.monotonic()
+            if frame_time >= self.next_frame_time:
+                break
+        self.next_frame_time = max(self.next_frame_time + self.frame_period, frame_time) # Doesn't catch up with a burst of frames after a stall
+        frame_read, frame = self.video_capture.retrieve()
+        if frame_read == False:
+            return None
+        if self.encode_frames == True:
+            return self.encode(frame)
+        return frame
+
+    def encode(self, frame): # Returns the JPEG bytes of the frame or None if it can't be encoded
+        if isinstance(frame, bytes): # Already encoded
+            return frame
+        encoded, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        if encoded == False:
+            return None
+        return jpeg.tobytes()
+
+    def frame_size(self, frame):
+        if isinstance(frame, bytes):
+            return len(frame)
+        return frame.nbytes
+
+    def close(self):
+        if self.video_capture != None:
+            self.video_capture.release()
+            self.video_capture = None
+
+class FakeFrameSource(object): # The class for generating numbered frames at a fixed rate so that the buffered camera can be run without a camera
+    def __init__(self, frame_rate = 10, open_delay = 0):
+        self.frame_period = 1 / frame_rate
+        self.open_delay = open_delay # Simulates the device open and auto exposure warm-up time
+        self.frame_count = 0
+        self.next_frame_time = None
+
+    def open(self):
+        time.sleep(self.open_delay)
+        self.next_frame_time = time.monotonic()
+        return True
+
+    def read_frame(self):
+        delay = self.next_frame_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_frame_time += self.frame_period
+        self.frame_count += 1
+        comment = ('Frame ' + str(self.frame_count) + ' at ' + str(time.monotonic())).encode()
+        return b'\xff\xd8\xff\xfe' + struct.pack('>H', len(comment) + 2) + comment + b'\xff\xd9' # JPEG containing only a comment segment
+
+    def encode(self, frame):
+        return frame
+
+    def frame_size(self, frame):
+        return len(frame)
+
+    def close(self):
+        pass
+
+class BufferedCamera(object): # The class for the camera thread that keeps the video device open and buffers the most recent frames
+    def __init__(self, frame_source, buffer_seconds = 5, max_buffer_bytes = 20000000):
+        self.frame_source = frame_source
+        self.buffer_seconds = buffer_seconds
+        self.max_buffer_bytes = max_buffer_bytes # Bounds the buffer memory when frames are larger than expected
+        self.frames = collections.deque() # (frame time, frame) in time order. The frame source encodes the frames that are saved
+        self.buffer_bytes = 0
+        self.frame_available = threading.Condition()
+        self.camera_enable = True
+        self.camera_paused = threading.Event()
+        self.released_time = None # When the device was released. Rings after this only have stale frames until the device has been reopened
+        self.camera_thread = None
+
+    def start(self):
+        self.camera_thread = Thread(target=self.run, name='camera', daemon=True)
+        self.camera_thread.start()
+
+    def is_alive(self):
+        return self.camera_thread != None and self.camera_thread.is_alive()
+
+    def pause(self): # Releases the video device, e.g. so that Linphone can use it for a video call
+        with self.frame_available:
+            if self.released_time == None:
+                self.released_time = time.monotonic()
+        self.camera_paused.set()
+
+    def resume(self):
+        self.camera_paused.clear()
+
+    def terminate(self):
+        self.camera_enable = False
+        self.camera_paused.clear()
+
+    def run(self): # The frame buffering method
+        while self.camera_enable == True:
+            if self.frame_source.open() == False:
+                print("Unable to open the camera. Retrying in 5 seconds")
+                self.frame_source.close()
+                time.sleep(5)
+                continue
+            with self.frame_available:
+                self.frames.clear() # Frames from before the device was released are stale
+                self.buffer_bytes = 0
+                self.released_time = None
+            while self.camera_enable == True and self.camera_paused.is_set() == False:
+                frame = self.frame_source.read_frame()
+                if frame is None: # Raw frames are arrays, which can't be compared with ==
+                    print("Camera read failed. Reopening camera")
+                    break
+                frame_time = time.monotonic()
+                with self.frame_available:
+                    self.frames.append((frame_time, frame))
+                    self.buffer_bytes += self.frame_source.frame_size(frame)
+                    while self.frames[0][0] < frame_time - self.buffer_seconds or self.buffer_bytes > self.max_buffer_bytes:
+                        self.buffer_bytes -= self.frame_source.frame_size(self.frames.popleft()[1])
+                    self.frame_available.notify_all()
+            self.frame_source.close() # Buffered frames are kept while paused so that a clip being recorded keeps its pre-ring frames
+            while self.camera_enable == True and self.camera_paused.is_set() == True:
+                time.sleep(0.1)
+
+    def frame_at(self, capture_time, timeout = 2): # Returns the latest frame taken at or before capture_time, waiting for a frame if none has been taken yet
+        deadline = time.monotonic() + timeout
+        with self.frame_available:
+            while len(self.frames) == 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.frame_available.wait(remaining)
+            selected_frame = self.frames[0][1] # The earliest frame is used if the capture time is before the buffer start
+            for frame_time, frame in self.frames:
+                if frame_time > capture_time:
+                    break
+                selected_frame = frame
+            return selected_frame
+
+    def frame_after(self, start_time, timeout = 5): # Returns the first frame taken at or after start_time, waiting for it to be taken
+        deadline = time.monotonic() + timeout
+        with self.frame_available:
+            while True:
+                for frame_time, frame in self.frames:
+                    if frame_time >= start_time:
+                        return frame
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.frame_available.wait(remaining)
+
+    def wait_for_frame(self, timeout = 10): # Returns True once the camera has taken a frame, i.e. it has opened the device and warmed up
+        return self.frame_after(0, timeout) is not None
+
+    def frames_between(self, start_time, finish_time): # Returns the buffered frames taken between the start and finish times
+        with self.frame_available:
+            return [frame for frame_time, frame in self.frames if frame_time >= start_time and frame_time <= finish_time]
+
+    def record_clip(self, clip_file_name, ring_time, pre_ring_seconds, post_ring_seconds): # Saves the frames around the ring as a Motion JPEG clip
+        delay = ring_time + post_ring_seconds - time.monotonic()
+        if delay > 0:
+            time.sleep(delay) # Wait for the post-ring frames
+        frames = self.frames_between(ring_time - pre_ring_seconds, ring_time + post_ring_seconds)
+        if len(frames) == 0:
+            print("No camera frames available for the clip")
+            return False
+        with open(clip_file_name, 'wb') as clip_file:
+            for frame in frames:
+                jpeg = self.frame_source.encode(frame)
+                if jpeg != None:
+                    clip_file.write(jpeg)
+        return True
+
+    def capture(self, picture_file_name, ring_time = None): # Saves the frame at the ring edge or the latest frame if there's no ring time
+        if ring_time == None:
+            ring_time = time.monotonic()
+        with self.frame_available:
+            released_time = self.released_time
+        if released_time != None and ring_time >= released_time: # The device was released at the ring, so the first frame once it's reopened is used
+            frame = self.frame_after(ring_time)
+        else:
+            frame = self.frame_at(ring_time)
+        if frame is None:
+            print("No camera frame available")
+            return False
+        jpeg = self.frame_source.encode(frame) # Only the captured frame is encoded
+        if jpeg == None:
+            print("Camera frame encoding failed")
+            return False
+        with open(picture_file_name, 'wb') as picture_file:
+            picture_file.write(jpeg)
+        return True
+
+class SimulatedCamera(BufferedCamera): # The class for a buffered camera fed by fake frames that records when each picture was captured
+    def __init__(self, frame_rate = 10, buffer_seconds = 5, warm_up_time = 0):
+        BufferedCamera.__init__(self, FakeFrameSource(frame_rate, warm_up_time), buffer_seconds)
+        self.capture_times = collections.deque(maxlen=1000)
+
+    def capture(self, picture_file_name, ring_time = None):
+        captured = BufferedCamera.capture(self, picture_file_name, ring_time)
+        if captured == True:
+            self.capture_times.append(time.monotonic())
+        return captured
+
+class AlsaAudioOutput(object): # The class for playing decoded messages through an ALSA device that's kept open between messages
+    sample_formats = {1: 'PCM_FORMAT_U8', 2: 'PCM_FORMAT_S16_LE', 3: 'PCM_FORMAT_S24_3LE', 4: 'PCM_FORMAT_S32_LE'} # Sample width in bytes: alsaaudio format
+    
+    def __init__(self, device = 'front:CARD=Device,DEV=0', period_size = 1024):
+        self.device = device
+        self.period_size = period_size
+        self.pcm = None
+        self.pcm_parameters = None
+        self.file_player = AplayAudioOutput(device) # Plays the messages that can't be decoded
+
+    def open(self, channels, sample_width, frame_rate): # Only reopens the device if the message has a different format
+        if self.pcm != None and self.pcm_parameters == (channels, sample_width, frame_rate):
+            return
+        self.close()
+        self.pcm = alsaaudio.PCM(type=alsaaudio.PCM_PLAYBACK, mode=alsaaudio.PCM_NORMAL, device=self.device, channels=channels, rate=frame_rate,
+                                 format=getattr(alsaaudio, self.sample_formats[sample_width]), periodsize=self.period_size)
+        self.pcm_parameters = (channels, sample_width, frame_rate)
+
+    def prepare(self, channels, sample_width, frame_rate): # Opens the device when the messages are loaded, so that the first ring doesn't wait for it
+        try:
+            self.open(channels, sample_width, frame_rate)
+            return True
+        except alsaaudio.ALSAAudioError as error:
+            print("Unable to open audio device " + self.device + ": " + repr(error))
+            self.close() # Opened again by the first message
+            return False
+
+    def play(self, channels, sample_width, frame_rate, frames): # A write error, e.g. after the device has been reset, reopens the device and the message
+        # is played once more
+        for attempt in range(2):
+            try:
+                self.open(channels, sample_width, frame_rate)
+                self.write(channels, sample_width, frames)
+                return
+            except alsaaudio.ALSAAudioError as error:
+                print("Message playback failed with " + repr(error))
+                self.close()
+
+    def play_file(self, message_file): # The device is released so that aplay can open it
+        self.close()
+        self.file_player.play_file(message_file)
+
+    def write(self, channels, sample_width, frames):
+        chunk_size = self.period_size * channels * sample_width
+        for position in range(0, len(frames), chunk_size):
+            chunk = frames[position:position + chunk_size]
+            if len(chunk) < chunk_size: # alsaaudio writes whole periods, so the last one is padded with silence
+                silence = b'\x80' if sample_width == 1 else b'\x00'
+                chunk += silence * (chunk_size - len(chunk))
+            self.pcm.write(chunk)
+        if hasattr(self.pcm, 'drain'):
+            self.pcm.drain()
+
+    def close(self):
+        if self.pcm != None:
+            self.pcm.close()
+            self.pcm = None
+
+class AplayAudioOutput(object): # The class for playing decoded messages through aplay when alsaaudio isn't installed. The message is piped from memory
+    def __init__(self, device = 'front:CARD=Device,DEV=0'):
+        self.device = device
+
+    def prepare(self, channels, sample_width, frame_rate): # aplay opens the device for each message
+        return True
+
+    def play(self, channels, sample_width, frame_rate, frames):
+        sample_formats = {1: 'U8', 2: 'S16_LE', 3: 'S24_3LE', 4: 'S32_LE'}
+        aplay_command = ['aplay', '-q', '-D', self.device, '-t', 'raw', '-f', sample_formats[sample_width], '-c', str(channels), '-r', str(frame_rate)]
+        try:
+            subprocess.run(aplay_command, input=frames)
+        except OSError as error:
+            print("Message playback failed with " + repr(error))
+
+    def play_file(self, message_file): # For messages that can't be decoded, e.g. VOC or AU files, which aplay reads itself
+        try:
+            subprocess.run(['aplay', '-q', '-D', self.device, message_file])
+        except OSError as error:
+            print("Message playback failed with " + repr(error))
+
+    def close(self):
+        pass
+
+class NullAudioOutput(object): # The class for discarding decoded messages, so that playback can be tested without a sound card. Takes as long as the message
+    def __init__(self):
+        self.play_times = collections.deque(maxlen=1000)
+
+    def prepare(self, channels, sample_width, frame_rate):
+        return True
+
+    def play(self, channels, sample_width, frame_rate, frames):
+        self.play_times.append(time.monotonic())
+        time.sleep(len(frames) / (channels * sample_width * frame_rate))
+
+    def play_file(self, message_file):
+        self.play_times.append(time.monotonic())
+
+    def close(self):
+        pass
+
+class CachedAudioPlayer(object): # The class for playing messages that are read and decoded once and then played from memory. Messages that the wave
+    # module can't decode, e.g. VOC, AU or some extensible WAV files, are played from their files by aplay, as they were before messages were cached
+    def __init__(self, output, message_files = ()):
+        self.output = output
+        self.messages = {} # Message file: (channels, sample width, frame rate, frames)
+        self.undecoded_messages = set() # Message files that are played by aplay
+        self.play_lock = Lock()
+        for message_file in message_files:
+            self.load(message_file)
+
+    def load(self, message_file): # Returns False if the message can't be played
+        if message_file in self.messages or message_file in self.undecoded_messages:
+            return True
+        try:
+            with wave.open(message_file, 'rb') as message_wave:
+                self.messages[message_file] = (message_wave.getnchannels(), message_wave.getsampwidth(), message_wave.getframerate(),
+                                               message_wave.readframes(message_wave.getnframes()))
+            return True
+        except (EOFError, wave.Error) as error:
+            print("Unable to decode message " + message_file + " (" + repr(error) + "). It will be played by aplay")
+            self.undecoded_messages.add(message_file)
+            return True
+        except OSError as error:
+            print("Unable to load message " + message_file + ": " + repr(error))
+            return False
+
+    def prepare(self, message_file): # Opens the output for the message's format
+        if self.load(message_file) == False:
+            return False
+        if message_file in self.undecoded_messages:
+            return True
+        channels, sample_width, frame_rate, frames = self.messages[message_file]
+        with self.play_lock:
+            return self.output.prepare(channels, sample_width, frame_rate)
+
+    def play(self, message_file):
+        if self.load(message_file) == False: # Only reads the file if it wasn't loaded at startup
+            return
+        with self.play_lock:
+            if message_file in self.undecoded_messages:
+                self.output.play_file(message_file)
+            else:
+                self.output.play(*self.messages[message_file])
+
+    def terminate(self):
+        self.output.close()
+
+class SimulatedAudioPlayer(object): # The class for simulating message playback with a fixed duration, so that the monitor can be run without message files
+    def __init__(self, duration = 1):
+        self.duration = duration
+        self.play_times = collections.deque(maxlen=1000)
+
+    def load(self, message_file):
+        return True
+
+    def prepare(self, message_file):
+        return True
+
+    def play(self, message_file):
+        self.play_times.append(time.monotonic())
+        time.sleep(self.duration)
+
+    def terminate(self):
+        pass
+
+class CaptureRetention(object): # The class for removing old pictures and clips from the capture directory
+    def __init__(self, capture_directory, max_megabytes = None, max_days = None, on_remove = None):
+        self.capture_directory = capture_directory
+        self.on_remove = on_remove # Called with the paths of the removed files, e.g. to drop them from the event index
+        self.max_bytes = None
+        if max_megabytes != None:
+            self.max_bytes = max_megabytes * 1000000
+        self.max_age = None
+        if max_days != None:
+            self.max_age = max_days * 86400
+        self.capture_file_endings = ("picturedump.jpg", "clipdump.mjpeg") # Only files written by the monitor are removed
+        self.prune_lock = Lock()
+
+    def capture_files(self): # Returns (modification time, size, path) for each capture file, oldest first
+        capture_files = []
+        try:
+            directory_entries = os.scandir(self.capture_directory)
+        except OSError as error:
+            print("Unable to read the capture directory: " + repr(error))
+            return capture_files
+        with directory_entries:
+            for entry in directory_entries:
+                if entry.is_file() and entry.name.endswith(self.capture_file_endings):
+                    entry_stat = entry.stat()
+                    capture_files.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+        capture_files.sort()
+        return capture_files
+
+    def prune(self): # Removes capture files that are too old, then the oldest capture files until the directory is within its size limit
+        if self.max_bytes == None and self.max_age == None:
+            return 0
+        with self.prune_lock:
+            capture_files = self.capture_files()
+            total_bytes = sum(file_size for modified_time, file_size, path in capture_files)
+            oldest_allowed = time.time() - self.max_age if self.max_age != None else None
+            removed_files = []
+            for modified_time, file_size, path in capture_files:
+                too_old = oldest_allowed != None and modified_time < oldest_allowed
+                too_big = self.max_bytes != None and total_bytes > self.max_bytes
+                if too_old == False and too_big == False:
+                    break
+                try:
+                    os.remove(path)
+                    total_bytes -= file_size
+                    removed_files.append(path)
+                except OSError as error:
+                    print("Unable to remove " + path + ": " + repr(error))
+            if len(removed_files) > 0:
+                print("Removed " + str(len(removed_files)) + " old capture files")
+                if self.on_remove != None:
+                    self.on_remove(removed_files)
+            return len(removed_files)
+
+class RingEventIndex(object): # The class for the on-disk index of rings, with their mode, outcome, captures and notification results
+    def __init__(self, database_file = None, max_query_results = 500):
+        self.database_file = database_file # None disables the index
+        self.max_query_results = max_query_results
+        self.connection = None
+        # The database is only used on the index thread. Updates are queued, so that ring handling doesn't wait for the SD card
+        self.index_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='event_index')
+        if self.database_file != None:
+            self.index_executor.submit(self.open_database)
+
+    def open_database(self):
+        try:
+            self.connection = sqlite3.connect(self.database_file)
+            self.connection.execute('PRAGMA journal_mode=WAL') # Fewer SD card writes per commit
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS rings (event_id TEXT PRIMARY KEY, ring_time REAL NOT NULL, mode TEXT NOT NULL, outcome TEXT,
+                                                  door_opened INTEGER NOT NULL DEFAULT 0, call_answered INTEGER, notifications_sent INTEGER NOT NULL DEFAULT 0,
+                                                  notifications_failed INTEGER NOT NULL DEFAULT 0, detection_latency REAL, duration REAL, station TEXT);
+                CREATE INDEX IF NOT EXISTS rings_by_time ON rings (ring_time);
+                CREATE INDEX IF NOT EXISTS rings_by_mode ON rings (mode, ring_time);
+                CREATE TABLE IF NOT EXISTS captures (event_id TEXT NOT NULL, kind TEXT NOT NULL, path TEXT NOT NULL, capture_time REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS captures_by_event ON captures (event_id);
+                CREATE INDEX IF NOT EXISTS captures_by_path ON captures (path);''')
+            if 'station' not in [column[1] for column in self.connection.execute('PRAGMA table_info(rings)')]: # Indexes from before multi-station support
+                self.connection.execute('ALTER TABLE rings ADD COLUMN station TEXT')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS rings_by_station ON rings (station, ring_time)')
+            self.connection.commit()
+        except sqlite3.Error as error:
+            print("Unable to open the event index " + self.database_file + ": " + repr(error))
+            self.connection = None
+
+    def terminate(self): # Closes the database once the queued updates have been written
+        if self.database_file != None:
+            self.index_executor.submit(self.close_database)
+        self.index_executor.shutdown(wait=True)
+
+    def close_database(self):
+        if self.connection != None:
+            self.connection.close()
+            self.connection = None
+
+    def update(self, statement, parameters = (), many = False): # Queues an update for the index thread
+        if self.database_file == None:
+            return
+        try:
+            self.index_executor.submit(self.execute, statement, parameters, many)
+        except RuntimeError: # The index has been terminated
+            pass
+
+    def execute(self, statement, parameters, many):
+        if self.connection == None:
+            return
+        try:
+            if many == True:
+                self.connection.executemany(statement, parameters)
+            else:
+                self.connection.execute(statement, parameters)
+            self.connection.commit()
+        except sqlite3.Error as error:
+            print("Event index update failed with " + repr(error))
+
+    def add_ring(self, event_id, ring_time, mode, station = None):
+        self.update('INSERT OR REPLACE INTO rings (event_id, ring_time, mode, station) VALUES (?, ?, ?, ?)', (event_id, ring_time, mode, station))
+
+    def add_capture(self, event_id, kind, path): # kind is 'Photo' or 'Clip'
+        self.update('INSERT INTO captures (event_id, kind, path, capture_time) VALUES (?, ?, ?, ?)', (event_id, kind, path, time.time()))
+
+    def set_door_opened(self, event_id):
+        self.update('UPDATE rings SET door_opened = 1 WHERE event_id = ?', (event_id,))
+
+    def set_call_answered(self, event_id, answered):
+        self.update('UPDATE rings SET call_answered = ? WHERE event_id = ?', (int(answered), event_id))
+
+    def add_notification(self, event_id, delivered):
+        if delivered == True:
+            self.update('UPDATE rings SET notifications_sent = notifications_sent + 1 WHERE event_id = ?', (event_id,))
+        else:
+            self.update('UPDATE rings SET notifications_failed = notifications_failed + 1 WHERE event_id = ?', (event_id,))
+
+    def finish_ring(self, event_id, outcome, duration, detection_latency):
+        self.update('UPDATE rings SET outcome = ?, duration = ?, detection_latency = ? WHERE event_id = ?', (outcome, duration, detection_latency, event_id))
+
+    def remove_files(self, paths): # Drops captures that have been removed from the capture directory
+        self.update('DELETE FROM captures WHERE path = ?', [(path,) for path in paths], many = True)
+
+    @staticmethod
+    def parse_time(time_value): # Accepts epoch seconds, 'YYYY-MM-DD', 'YYYY-MM-DD HH:MM' or 'YYYY-MM-DD HH:MM:SS'
+        if time_value == None or isinstance(time_value, (int, float)):
+            return time_value
+        for time_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+            try:
+                return datetime.strptime(time_value, time_format).timestamp()
+            except ValueError:
+                pass
+        raise ValueError('Invalid time ' + repr(time_value))
+
+    def query(self, since = None, until = None, mode = None, door_opened = None, limit = 50, timeout = 10, station = None): # Returns the matching rings, newest first
+        if self.database_file == None:
+            return []
+        return self.index_executor.submit(self.run_query, self.parse_time(since), self.parse_time(until), mode, door_opened,
+                                          max(1, min(limit, self.max_query_results)), station).result(timeout)
+
+    def run_query(self, since, until, mode, door_opened, limit, station = None):
+        if self.connection == None:
+            return []
+        conditions = []
+        parameters = []
+        for condition, parameter in (('ring_time >= ?', since), ('ring_time < ?', until), ('mode = ?', mode), ('door_opened = ?', door_opened),
+                                     ('station = ?', station)):
+            if parameter != None:
+                conditions.append(condition)
+                parameters.append(parameter)
+        statement = ('SELECT event_id, ring_time, mode, outcome, door_opened, call_answered, notifications_sent, notifications_failed, detection_latency, duration, '
+                     'station FROM rings')
+        if len(conditions) > 0:
+            statement += ' WHERE ' + ' AND '.join(conditions)
+        statement += ' ORDER BY ring_time DESC LIMIT ?'
+        parameters.append(limit)
+        events = []
+        for row in self.connection.execute(statement, parameters):
+            call_answered = None
+            if row[5] != None:
+                call_answered = row[5] == 1
+            events.append({'Event Id': row[0], 'Ring Time': datetime.fromtimestamp(row[1]).isoformat(timespec='seconds'), 'Mode': row[2], 'Outcome': row[3],
+                           'Door Opened': row[4] == 1, 'Call Answered': call_answered, 'Notifications Sent': row[6], 'Notifications Failed': row[7],
+                           'Detection Latency': row[8], 'Duration': row[9], 'Station': row[10], 'Photos': [], 'Clip': None})
+        if len(events) > 0:
+            events_by_id = {event['Event Id']: event for event in events}
+            capture_rows = self.connection.execute('SELECT event_id, kind, path FROM captures WHERE event_id IN (' + ','.join('?' * len(events)) +
+                                                   ') ORDER BY capture_time', list(events_by_id))
+            for event_id, kind, path in capture_rows:
+                if kind == 'Clip':
+                    events_by_id[event_id]['Clip'] = path
                 else:
-                    GPIO.output(self.auto_led_off, False)
-                    self.auto_led_state = True
-                self.led_counter += 1
-                time.sleep(self.cycle_duration) # cycle_duration sets the time increments for the flashing of the LED
+                    events_by_id[event_id]['Photos'].append(path)
+        return events
+
+class LinphoneCallController(object): # The class for the long-lived Linphone process that places the manual mode SIP calls
+    def __init__(self, video_parameter, debug_log_file, config_file, answer_timeout = 30, max_call_duration = 300):
+        self.linphone_command = ['linphonec', '-' + video_parameter, '-d', '1', '-l', debug_log_file, '-c', config_file]
+        self.answer_timeout = answer_timeout # Unanswered calls are terminated after this time
+        self.max_call_duration = max_call_duration # Answered calls are terminated after this time if the callee hasn't hung up
+        self.linphone_process = None
+        self.process_lock = Lock() # Only one linphonec is started, e.g. when the startup self test and manual mode both start Linphone
+        self.call_state_changed = threading.Condition()
+        self.call_state = 'Idle' # Idle, Dialling, Ringing, Answered or Hung Up
+        self.call_state_time = time.monotonic()
+        self.registered = False
+        self.hang_up_requested = False
+        self.ringing_time = None # When the callee's phone started ringing on the current call
+        self.call_setup_latency = None # Dialling to the callee's phone ringing, or to the answer if no ringing was reported
+        self.answer_latency = None # Dialling to the answer
+
+    def is_running(self):
+        return self.linphone_process != None and self.linphone_process.poll() == None
+
+    def start(self, ready_timeout = 5): # Starts linphonec and waits for SIP registration
+        with self.process_lock:
+            return self.start_process(ready_timeout)
+
+    def start_process(self, ready_timeout): # Must be called with process_lock held
+        if self.is_running() == True:
+            return True
+        print('Starting Linphone')
+        try:
+            self.linphone_process = subprocess.Popen(self.linphone_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                                     universal_newlines=True, bufsize=1)
+        except OSError as error:
+            print('Unable to start Linphone: ' + repr(error))
+            self.linphone_process = None
+            return False
+        self.registered = False
+        self.set_call_state('Idle')
+        self.linphone_output_thread = Thread(target=self.read_linphone_output, args=(self.linphone_process,), name='linphone', daemon=True)
+        self.linphone_output_thread.start()
+        with self.call_state_changed:
+            self.call_state_changed.wait_for(lambda: self.registered == True or self.is_running() == False, ready_timeout)
+        if self.registered == False:
+            print('Linphone SIP registration not confirmed')
+        return self.is_running()
+
+    def stop(self):
+        with self.process_lock:
+            self.stop_process()
+
+    def stop_process(self): # Must be called with process_lock held
+        if self.linphone_process == None:
+            return
+        print('Stopping Linphone')
+        self.send_command('quit')
+        try:
+            self.linphone_process.wait(timeout = 5)
+        except subprocess.TimeoutExpired:
+            self.linphone_process.kill()
+        self.linphone_process = None
+        self.set_call_state('Idle')
+
+    def send_command(self, command):
+        try:
+            self.linphone_process.stdin.write(command + '\n')
+            self.linphone_process.stdin.flush()
+            return True
+        except (OSError, AttributeError, ValueError) as error:
+            print('Unable to send Linphone command: ' + repr(error))
+            return False
+
+    def set_call_state(self, call_state):
+        with self.call_state_changed:
+            if call_state != self.call_state:
+                self.call_state = call_state
+                self.call_state_time = time.monotonic()
+                if call_state == 'Ringing' and self.ringing_time == None:
+                    self.ringing_time = self.call_state_time
+            self.call_state_changed.notify_all()
+
+    def read_linphone_output(self, linphone_process): # Tracks the call state from the linphonec console messages
+        for line in linphone_process.stdout:
+            message = line.lower()
+            if 'registration' in message and 'successful' in message:
+                self.registered = True
+                self.set_call_state(self.call_state)
+            elif 'establishing call' in message:
+                self.set_call_state('Dialling')
+            elif 'ringing' in message or 'early media' in message:
+                self.set_call_state('Ringing')
+            elif 'connected' in message or 'call answered' in message:
+                self.set_call_state('Answered')
+            elif 'ended' in message or 'terminated' in message or 'declined' in message or 'error' in message or 'busy' in message or 'not found' in message:
+                self.set_call_state('Hung Up')
+        if linphone_process == self.linphone_process:
+            self.set_call_state('Hung Up') # linphonec has exited
+
+    def call(self, sip_address, answer_timeout = None, max_call_duration = None, call_time_limit = None): # Calls the SIP address and waits until the callee
+        # hangs up or the call times out. call_time_limit bounds the whole call from dialling. Returns True if the call was answered
+        if answer_timeout == None:
+            answer_timeout = self.answer_timeout
+        if max_call_duration == None:
+            max_call_duration = self.max_call_duration
+        if self.is_running() == False and self.start() == False:
+            return False
+        with self.call_state_changed:
+            if self.hang_up_requested == True: # Hung up before it was dialled
+                self.hang_up_requested = False
+                return False
+        dial_time = time.monotonic()
+        with self.call_state_changed:
+            self.ringing_time = None
+        self.call_setup_latency = None
+        self.answer_latency = None
+        self.set_call_state('Dialling')
+        if self.send_command('call ' + sip_address) == False:
+            self.set_call_state('Idle')
+            return False
+        with self.call_state_changed:
+            self.call_state_changed.wait_for(lambda: self.call_state in ('Answered', 'Hung Up') or self.hang_up_requested == True, answer_timeout)
+            answered = self.call_state == 'Answered'
+            if self.ringing_time != None:
+                self.call_setup_latency = self.ringing_time - dial_time
+        if self.call_setup_latency != None:
+            print('Linphone call ringing ' + str(round(self.call_setup_latency, 2)) + ' seconds after dialling')
+        if answered == True:
+            self.answer_latency = self.call_state_time - dial_time
+            if self.call_setup_latency == None: # Answered without a ringing report, e.g. auto answer
+                self.call_setup_latency = self.answer_latency
+            print('Linphone call answered ' + str(round(self.answer_latency, 2)) + ' seconds after dialling')
+            if call_time_limit != None: # Only the time left after the answer
+                max_call_duration = max(min(max_call_duration, call_time_limit - (time.monotonic() - dial_time)), 0)
+            with self.call_state_changed:
+                self.call_state_changed.wait_for(lambda: self.call_state == 'Hung Up' or self.hang_up_requested == True, max_call_duration)
+        if self.call_state != 'Hung Up':
+            print('Terminating Linphone call')
+            self.send_command('terminate')
+        else:
+            print('Linphone call ended by the callee')
+        with self.call_state_changed:
+            self.hang_up_requested = False
+        self.set_call_state('Idle')
+        return answered
+
+    def hang_up(self): # Ends the call in progress, or the next call if it's about to be dialled, e.g. when a ring interrupts the startup test call
+        with self.call_state_changed:
+            self.hang_up_requested = True
+            self.call_state_changed.notify_all()
+
+class AutoAnswerSchedule(object): # The class for working out when auto answer is allowed. The windows are compiled into sorted transition times
+    day_names = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+    def __init__(self, windows, holidays = (), clock = datetime.now):
+        # windows maps each weekday (0 = Monday) to a list of ('HH:MM', 'HH:MM') start and finish times. A finish time before
+        # the start time runs past midnight. holidays are dates ('YYYY-MM-DD' or date) on which auto answer isn't allowed
+        self.windows = windows
+        self.holidays = set()
+        for holiday in holidays:
+            if isinstance(holiday, str):
+                holiday = datetime.strptime(holiday, '%Y-%m-%d').date()
+            self.holidays.add(holiday)
+        self.clock = clock
+        self.compile_windows()
+
+    @staticmethod
+    def hourly_windows(active_auto_start, active_auto_finish, disable_weekend): # Windows for the original whole hour start and finish setting
+        windows = {}
+        for weekday in range(7):
+            if (disable_weekend == True and weekday >= 5) or active_auto_finish <= active_auto_start:
+                windows[weekday] = []
+            else:
+                windows[weekday] = [('%02d:00' % active_auto_start, '%02d:00' % active_auto_finish)]
+        return windows
+
+    @staticmethod
+    def minute_of_day(time_text):
+        hour, minute = time_text.split(':')
+        return int(hour) * 60 + int(minute)
+
+    def compile_windows(self): # Merges the windows into minute-of-week intervals and then into sorted (minute, active) transitions
+        week_minutes = 7 * 1440
+        intervals = []
+        for weekday, day_windows in self.windows.items():
+            for start_text, finish_text in day_windows:
+                start = weekday * 1440 + self.minute_of_day(start_text)
+                finish = weekday * 1440 + self.minute_of_day(finish_text)
+                if finish <= start:
+                    finish += 1440 # Runs past midnight
+                if finish > week_minutes: # Runs past the end of Sunday, so the remainder wraps to Monday
+                    intervals.append((0, finish - week_minutes))
+                    finish = week_minutes
+                intervals.append((start, finish))
+        intervals.sort()
+        merged_intervals = []
+        for start, finish in intervals:
+            if len(merged_intervals) > 0 and start <= merged_intervals[-1][1]:
+                merged_intervals[-1][1] = max(merged_intervals[-1][1], finish)
+            else:
+                merged_intervals.append([start, finish])
+        self.transition_minutes = []
+        self.transition_states = []
+        for start, finish in merged_intervals:
+            self.transition_minutes.append(start)
+            self.transition_states.append(True)
+            if finish < week_minutes:
+                self.transition_minutes.append(finish)
+                self.transition_states.append(False)
+        self.day_transitions = [[] for weekday in range(7)] # Minute-of-day transition times for each weekday
+        for minute in self.transition_minutes:
+            self.day_transitions[minute // 1440].append(minute % 1440)
+
+    def is_active(self, now = None):
+        if now == None:
+            now = self.clock()
+        if now.date() in self.holidays:
+            return False
+        index = bisect.bisect_right(self.transition_minutes, now.weekday() * 1440 + now.hour * 60 + now.minute) - 1
+        if index < 0: # Before the first transition of the week. A window that's open at the start of Monday has a transition at minute 0
+            return False
+        return self.transition_states[index]
+
+    def next_transition(self, now = None): # Returns the time when is_active() next changes or None if it never changes
+        if now == None:
+            now = self.clock()
+        active = self.is_active(now)
+        for day_offset in range(9):
+            day_start = datetime.combine(now.date() + timedelta(days=day_offset), datetime.min.time())
+            candidates = [day_start] + [day_start + timedelta(minutes=minute) for minute in self.day_transitions[day_start.weekday()]]
+            for candidate in candidates:
+                if candidate > now and self.is_active(candidate) != active:
+                    return candidate
+        for holiday in sorted(self.holidays): # Holidays beyond the next week are the only remaining changes
+            if holiday > now.date() + timedelta(days=8) and active == True:
+                return datetime.combine(holiday, datetime.min.time())
+        return None
+
+    def describe(self):
+        descriptions = []
+        for weekday in range(7):
+            day_windows = self.windows.get(weekday, [])
+            if len(day_windows) == 0:
+                descriptions.append(self.day_names[weekday] + ' off')
             else:
-                self.led_counter = 0
+                descriptions.append(self.day_names[weekday] + ' ' + ', '.join(start + '-' + finish for start, finish in day_windows))
+        if len(self.holidays) > 0:
+            descriptions.append('Off on ' + ', '.join(holiday.isoformat() for holiday in sorted(self.holidays)))
+        return 'Auto Answer Windows: ' + '; '.join(descriptions)
+
+class StatusPublisher(object): # The class for publishing the doorbell status over mqtt. Only changes are published, bursts are coalesced and the status is retained
+    def __init__(self, client, topic = 'DoorbellStatus', qos = 1, coalesce_period = 0.2):
+        self.client = client
+        self.topic = topic
+        self.qos = qos
+        self.coalesce_period = coalesce_period # Status changes within this period are published as one message
+        self.publish_lock = Lock()
+        self.pending_status = None
+        self.pending_force = False
+        self.last_sent_status = None
+        self.last_retained_status = None
+        self.coalesce_timer = None
+        self.publish_counts = {'Published': 0, 'Unchanged': 0, 'Coalesced': 0, 'Events': 0}
+
+    def publish_status(self, status, force = False): # Publishes a retained status. force publishes immediately, even if the status hasn't changed
+        with self.publish_lock:
+            if force == False and self.pending_status == None and status == self.last_sent_status:
+                self.publish_counts['Unchanged'] += 1
+                return
+            if self.pending_status != None:
+                self.publish_counts['Coalesced'] += 1
+            self.pending_status = status
+            if force == True:
+                self.pending_force = True
+                self.flush_pending_status()
+            elif self.coalesce_timer == None:
+                self.coalesce_timer = threading.Timer(self.coalesce_period, self.flush)
+                self.coalesce_timer.daemon = True
+                self.coalesce_timer.start()
+
+    def publish_event(self, payload): # Publishes a message that isn't retained, e.g. a ringing pulse or a heartbeat, after any pending status
+        with self.publish_lock:
+            self.flush_pending_status()
+            self.client.publish(self.topic, payload, qos = self.qos)
+            self.publish_counts['Events'] += 1
+            if '"Status Update"' in payload:
+                self.last_sent_status = payload # So that the status following a ringing pulse is always published
+
+    def republish(self): # Publishes the current status again, e.g. when Home Manager asks for it
+        with self.publish_lock:
+            status = self.pending_status or self.last_retained_status
+        if status != None:
+            self.publish_status(status, force = True)
+
+    def flush(self):
+        with self.publish_lock:
+            self.flush_pending_status()
+
+    def flush_pending_status(self): # Must be called with publish_lock held
+        if self.coalesce_timer != None:
+            self.coalesce_timer.cancel()
+            self.coalesce_timer = None
+        status, force = self.pending_status, self.pending_force
+        self.pending_status, self.pending_force = None, False
+        if status == None:
+            return
+        if force == False and status == self.last_sent_status: # The coalesced changes ended where they started
+            self.publish_counts['Unchanged'] += 1
+            return
+        self.client.publish(self.topic, status, qos = self.qos, retain = True)
+        self.publish_counts['Published'] += 1
+        self.last_sent_status = status
+        self.last_retained_status = status
+
+class MqttCommandDispatcher(object): # The class for the mqtt command threads. Commands are validated on the mqtt thread and run on a command thread
+    def __init__(self, commands, queue_size = 100):
+        # Maps each service to ({required field: type}, handler, slow). Handlers are called with the parsed command.
+        # Slow commands run on their own thread so that they don't hold up the others
+        self.commands = commands
+        self.command_queues = {False: queue.Queue(maxsize=queue_size), True: queue.Queue(maxsize=queue_size)}
+        self.metrics_lock = Lock()
+        self.command_metrics = {}
+        self.rejected_commands = 0
+        self.command_threads = {}
+
+    def start(self): # Also restarts any command thread that has stopped
+        for slow, command_queue in self.command_queues.items():
+            if slow not in self.command_threads or self.command_threads[slow].is_alive() == False:
+                self.command_threads[slow] = Thread(target=self.run, args=(command_queue,), name='mqtt_commands', daemon=True)
+                self.command_threads[slow].start()
+
+    def is_alive(self):
+        return len(self.command_threads) == len(self.command_queues) and all(command_thread.is_alive() for command_thread in self.command_threads.values())
+
+    def terminate(self):
+        for command_queue in self.command_queues.values():
+            try:
+                command_queue.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def parse_command(self, payload): # Returns the validated command and its table entry or (None, None) if the payload is invalid
+        try:
+            parsed_json = json.loads(payload.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError) as error:
+            print('Invalid mqtt payload: ' + repr(error))
+            return None, None
+        if isinstance(parsed_json, dict) == False or isinstance(parsed_json.get('service'), str) == False or parsed_json['service'] not in self.commands:
+            print('invalid button')
+            return None, None
+        command = self.commands[parsed_json['service']]
+        required_fields = command[0]
+        for field, field_type in required_fields.items():
+            if isinstance(parsed_json.get(field), field_type) == False:
+                print('Invalid ' + parsed_json['service'] + ' command. ' + field + ' is missing or invalid')
+                return None, None
+        return parsed_json, command
+
+    def dispatch(self, payload): # Called on the mqtt thread. Never blocks or raises, because an exception would stop the mqtt thread
+        try:
+            parsed_json, command = self.parse_command(payload)
+            if parsed_json != None:
+                required_fields, handler, slow = command
+                self.command_queues[slow].put_nowait((parsed_json, handler, time.monotonic()))
+                return True
+        except queue.Full:
+            print('mqtt command queue full. ' + parsed_json['service'] + ' command dropped')
+        except Exception as error:
+            print('mqtt command rejected: ' + repr(error))
+        with self.metrics_lock:
+            self.rejected_commands += 1
+        return False
+
+    def run(self, command_queue): # The command processing method
+        while True:
+            queued_command = command_queue.get()
+            if queued_command == None:
+                break
+            parsed_json, handler, queued_time = queued_command
+            start_time = time.monotonic()
+            try:
+                handler(parsed_json)
+            except Exception as error:
+                print(parsed_json['service'] + ' command failed with ' + repr(error))
+            self.record_latency(parsed_json['service'], start_time - queued_time, time.monotonic() - start_time)
+
+    def record_latency(self, service, queue_latency, execution_latency):
+        with self.metrics_lock:
+            if service not in self.command_metrics:
+                self.command_metrics[service] = {'Count': 0, 'Total Queue Latency': 0.0, 'Max Queue Latency': 0.0, 'Total Execution Latency': 0.0,
+                                                 'Max Execution Latency': 0.0}
+            metrics = self.command_metrics[service]
+            metrics['Count'] += 1
+            metrics['Total Queue Latency'] += queue_latency
+            metrics['Max Queue Latency'] = max(metrics['Max Queue Latency'], queue_latency)
+            metrics['Total Execution Latency'] += execution_latency
+            metrics['Max Execution Latency'] = max(metrics['Max Execution Latency'], execution_latency)
+
+    def latency_metrics(self): # Returns the count and the average and maximum queueing and execution latencies in seconds for each service
+        with self.metrics_lock:
+            latency_metrics = {'Rejected': self.rejected_commands, 'Queue Depth': sum(command_queue.qsize() for command_queue in self.command_queues.values())}
+            for service, metrics in self.command_metrics.items():
+                latency_metrics[service] = {'Count': metrics['Count'], 'Average Queue Latency': metrics['Total Queue Latency'] / metrics['Count'],
+                                            'Max Queue Latency': metrics['Max Queue Latency'],
+                                            'Average Execution Latency': metrics['Total Execution Latency'] / metrics['Count'],
+                                            'Max Execution Latency': metrics['Max Execution Latency']}
+            return latency_metrics
+
+class MonitorMetrics(object): # The class for the monitor's counters, latency histograms and structured event log
+    latency_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300) # Histogram bucket upper bounds in seconds
+
+    def __init__(self, event_log_file = None, max_log_bytes = 1000000, log_backups = 3, batch_size = 50, flush_period = 5, constant_labels = None):
+        self.metrics_lock = Lock()
+        self.constant_labels = self.label_key(constant_labels or {}) # Added to every Prometheus sample, e.g. the station, so that stations can share an endpoint
+        self.counters = {} # (name, labels): value
+        self.histograms = {} # (name, labels): {'Buckets': [count per bucket], 'Sum': total, 'Count': count, 'Max': maximum}
+        self.gauge_sources = [] # Functions that return {(name, labels): value} when the metrics are read
+        # Events are written to the JSON lines event log in batches by the event log thread, so that recording an event doesn't wait for the SD card
+        self.event_log_file = event_log_file
+        self.max_log_bytes = max_log_bytes
+        self.log_backups = log_backups
+        self.batch_size = batch_size
+        self.flush_period = flush_period
+        self.event_batch = []
+        self.batch_ready = threading.Condition(self.metrics_lock)
+        self.log_enable = True
+        self.log_thread = None
+
+    @staticmethod
+    def label_key(labels):
+        return tuple(sorted(labels.items()))
+
+    def increment(self, name, amount = 1, **labels):
+        key = (name, self.label_key(labels))
+        with self.metrics_lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels): # Adds a latency in seconds to its histogram
+        key = (name, self.label_key(labels))
+        with self.metrics_lock:
+            if key not in self.histograms:
+                self.histograms[key] = {'Buckets': [0] * len(self.latency_buckets), 'Sum': 0.0, 'Count': 0, 'Max': 0.0}
+            histogram = self.histograms[key]
+            index = bisect.bisect_left(self.latency_buckets, value)
+            if index < len(self.latency_buckets):
+                histogram['Buckets'][index] += 1
+            histogram['Sum'] += value
+            histogram['Count'] += 1
+            histogram['Max'] = max(histogram['Max'], value)
+
+    def add_gauge_source(self, gauge_source):
+        self.gauge_sources.append(gauge_source)
+
+    def record(self, event_type, **fields): # Adds a timestamped event to the event log batch
+        event = {'Time': round(time.time(), 3), 'Event': event_type}
+        event.update(fields)
+        with self.batch_ready:
+            if self.event_log_file == None:
+                return
+            self.event_batch.append(event)
+            if len(self.event_batch) >= self.batch_size:
+                self.batch_ready.notify()
+
+    @contextlib.contextmanager
+    def span(self, stage, ring_id = None): # Times a stage of a ring sequence
+        start_time = time.time()
+        start = time.monotonic()
+        outcome = 'OK'
+        try:
+            yield
+        except Exception:
+            outcome = 'Failed'
+            raise
+        finally:
+            duration = time.monotonic() - start
+            self.observe('doorbell_stage_seconds', duration, stage = stage)
+            self.record('Span', Stage = stage, Ring = ring_id, Start = round(start_time, 3), Duration = round(duration, 4), Outcome = outcome)
+
+    def start(self):
+        if self.event_log_file != None:
+            self.log_thread = Thread(target=self.run, name='event_log', daemon=True)
+            self.log_thread.start()
+
+    def terminate(self): # Stops the event log thread once the last batch has been written
+        with self.batch_ready:
+            self.log_enable = False
+            self.batch_ready.notify()
+        if self.log_thread != None:
+            self.log_thread.join(10)
+
+    def run(self): # The event log thread
+        while True:
+            with self.batch_ready:
+                if self.log_enable == True and len(self.event_batch) < self.batch_size:
+                    self.batch_ready.wait(self.flush_period)
+                event_batch = self.event_batch
+                self.event_batch = []
+                log_enable = self.log_enable
+            if len(event_batch) > 0:
+                self.write_events(event_batch)
+            if log_enable == False:
+                break
+
+    def write_events(self, event_batch):
+        try:
+            if os.path.exists(self.event_log_file) and os.path.getsize(self.event_log_file) >= self.max_log_bytes:
+                self.rotate_event_log()
+            with open(self.event_log_file, 'a') as event_log:
+                event_log.write(''.join(json.dumps(event) + '\n' for event in event_batch))
+        except OSError as error:
+            print("Event log write failed with " + repr(error))
+
+    def rotate_event_log(self): # event_log_file.1 is the most recent backup
+        for backup in range(self.log_backups - 1, 0, -1):
+            if os.path.exists(self.event_log_file + '.' + str(backup)):
+                os.replace(self.event_log_file + '.' + str(backup), self.event_log_file + '.' + str(backup + 1))
+        if self.log_backups > 0:
+            os.replace(self.event_log_file, self.event_log_file + '.1')
+        else:
+            os.remove(self.event_log_file)
+
+    def read_gauges(self):
+        gauges = {}
+        for gauge_source in self.gauge_sources:
+            try:
+                gauges.update(gauge_source())
+            except Exception as error:
+                print("Gauge read failed with " + repr(error))
+        return gauges
+
+    @staticmethod
+    def metric_name(name, labels, extra_labels = ()):
+        labels = labels + tuple(extra_labels)
+        if len(labels) == 0:
+            return name
+        return name + '{' + ','.join(key + '="' + str(value).replace('"', '\\"') + '"' for key, value in labels) + '}'
+
+    def snapshot(self): # Returns the counters, histogram summaries and gauges, e.g. for the mqtt metrics topic
+        gauges = self.read_gauges()
+        with self.metrics_lock:
+            counters = {self.metric_name(name, labels): value for (name, labels), value in self.counters.items()}
+            histograms = {}
+            for (name, labels), histogram in self.histograms.items():
+                histograms[self.metric_name(name, labels)] = {'Count': histogram['Count'], 'Average': round(histogram['Sum'] / histogram['Count'], 4),
+                                                              'Max': round(histogram['Max'], 4)}
+        return {'Counters': counters, 'Latencies': histograms, 'Gauges': {self.metric_name(name, labels): value for (name, labels), value in gauges.items()}}
+
+    def prometheus_samples(self, families): # Adds the sample lines to families, {name: (type, [sample line])}
+        gauges = self.read_gauges()
+        with self.metrics_lock:
+            for metric_type, metrics in (('counter', self.counters), ('gauge', gauges)):
+                for (name, labels), value in sorted(metrics.items()):
+                    samples = families.setdefault(name, (metric_type, []))[1]
+                    samples.append(self.metric_name(name, self.constant_labels + labels) + ' ' + repr(float(value)))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                samples = families.setdefault(name, ('histogram', []))[1]
+                labels = self.constant_labels + labels
+                cumulative_count = 0
+                for upper_bound, bucket_count in zip(self.latency_buckets, histogram['Buckets']):
+                    cumulative_count += bucket_count
+                    samples.append(self.metric_name(name + '_bucket', labels, (('le', repr(float(upper_bound))),)) + ' ' + str(cumulative_count))
+                samples.append(self.metric_name(name + '_bucket', labels, (('le', '+Inf'),)) + ' ' + str(histogram['Count']))
+                samples.append(self.metric_name(name + '_sum', labels) + ' ' + repr(histogram['Sum']))
+                samples.append(self.metric_name(name + '_count', labels) + ' ' + str(histogram['Count']))
+
+    def prometheus_text(self): # Returns the metrics in the Prometheus text exposition format
+        return self.combined_prometheus_text([self])
+
+    @staticmethod
+    def combined_prometheus_text(metrics_list): # Returns the metrics of several stations with one TYPE line for each metric, as Prometheus requires
+        families = {}
+        for metrics in metrics_list:
+            metrics.prometheus_samples(families)
+        lines = []
+        for name, (metric_type, samples) in families.items():
+            lines.append('# TYPE ' + name + ' ' + metric_type)
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+class MetricsHttpServer(object): # The class for serving the metrics to Prometheus on /metrics
+    def __init__(self, metrics_list, port = 9101, address = '127.0.0.1'): # metrics_list may grow after the server has started, e.g. as stations are added
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = MonitorMetrics.combined_prometheus_text(list(metrics_list)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args): # Scrapes aren't logged
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+        self.server.daemon_threads = True
+
+    def start(self):
+        Thread(target=self.server.serve_forever, name='metrics_http', daemon=True).start()
+
+    def terminate(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class MonitorSupervisor(object): # The class for the supervisor thread. Runs on the wall clock, so a long ring sequence can't skew the heartbeat timing
+    def __init__(self, metrics, send_heartbeat = None, reconnect_mqtt = None, restart_components = None, restart_code = None, record_event = None,
+                 heartbeat_enabled = True, heartbeat_interval = 300, ack_timeout = 150, reboot_timeout = 1800, check_period = 5):
+        # Recovery escalates while Home Manager's heartbeat ack is overdue: the mqtt connection is re-established after ack_timeout, the mqtt client and
+        # command threads are restarted after twice ack_timeout and the Pi is only rebooted once reboot_timeout has passed without an ack. A station's
+        # supervisor runs with heartbeat_enabled False and only watches its components
+        self.send_heartbeat = send_heartbeat
+        self.reconnect_mqtt = reconnect_mqtt
+        self.restart_components = restart_components
+        self.restart_code = restart_code
+        self.metrics = metrics
+        self.record_event = record_event # Records the recoveries in the event log. Defaults to the metrics' event log
+        if self.record_event == None:
+            self.record_event = metrics.record
+        self.heartbeat_enabled = heartbeat_enabled
+        self.heartbeat_interval = heartbeat_interval
+        self.ack_timeout = ack_timeout
+        self.reboot_timeout = reboot_timeout # None never reboots
+        self.check_period = check_period
+        self.components = [] # (name, check, restart) for the watchdog
+        self.supervisor_lock = threading.Condition()
+        self.supervise = True
+        self.last_ack = time.monotonic()
+        self.last_heartbeat_sent = time.monotonic()
+        self.heartbeat_due = False # Sends the heartbeat at the next check, whenever the last ack was
+        self.recovery_step = 0 # 0 healthy, 1 mqtt reconnected, 2 components restarted, 3 rebooting
+        self.disconnected_time = None
+        self.ever_connected = False
+        self.last_recovery_time = None
+        self.supervisor_thread = None
+
+    def add_component(self, name, check, restart): # check returns False when the component needs restart to be called
+        self.components.append((name, check, restart))
+
+    def start(self):
+        self.supervisor_thread = Thread(target=self.run, name='supervisor', daemon=True)
+        self.supervisor_thread.start()
+
+    def terminate(self): # Doesn't wait, because the supervisor thread may be the one shutting the monitor down
+        with self.supervisor_lock:
+            self.supervise = False
+            self.supervisor_lock.notify()
+
+    def heartbeat_ack(self):
+        with self.supervisor_lock:
+            now = time.monotonic()
+            if self.recovery_step > 0:
+                print("Home Manager heartbeat restored after " + str(round(now - self.last_ack)) + " seconds")
+                self.record_event('Recovery', Cause = 'Heartbeat', Step = self.recovery_step, Duration = round(now - self.last_ack, 3))
+            self.last_ack = now
+            self.recovery_step = 0
+
+    def mqtt_connected(self):
+        with self.supervisor_lock:
+            now = time.monotonic()
+            if self.disconnected_time != None and self.ever_connected == True:
+                self.last_recovery_time = now - self.disconnected_time
+                print("mqtt connection restored after " + str(round(self.last_recovery_time, 2)) + " seconds")
+                self.metrics.observe('doorbell_mqtt_recovery_seconds', self.last_recovery_time)
+                self.record_event('Recovery', Cause = 'mqtt', Duration = round(self.last_recovery_time, 3))
+                self.heartbeat_due = True # Checks the link to Home Manager straight away
+                self.supervisor_lock.notify()
+            self.disconnected_time = None
+            self.ever_connected = True
+
+    def mqtt_disconnected(self):
+        with self.supervisor_lock:
+            if self.disconnected_time == None:
+                self.disconnected_time = time.monotonic()
+                self.metrics.increment('doorbell_mqtt_disconnections_total')
+
+    def run(self):
+        while True:
+            with self.supervisor_lock:
+                if self.supervise == True:
+                    self.supervisor_lock.wait(self.check_period)
+                if self.supervise == False:
+                    break
+            try:
+                self.check_components()
+                self.check_heartbeat()
+            except Exception as error: # The supervisor must keep running
+                print("Supervisor check failed with " + repr(error))
+
+    def check_components(self): # The watchdog
+        for name, check, restart in self.components:
+            if self.supervise == True and check() == False:
+                print("Watchdog restarting " + name)
+                self.metrics.increment('doorbell_component_restarts_total', component = name)
+                self.record_event('Restart', Component = name)
+                restart()
+
+    def check_heartbeat(self):
+        if self.heartbeat_enabled == False:
+            return
+        now = time.monotonic()
+        with self.supervisor_lock:
+            send_heartbeat = self.heartbeat_due == True or now - max(self.last_ack, self.last_heartbeat_sent) >= self.heartbeat_interval
+            if send_heartbeat == True:
+                self.last_heartbeat_sent = now
+                self.heartbeat_due = False
+            overdue_time = now - self.last_ack - self.heartbeat_interval # How long the ack has been overdue
+            recovery_step = self.recovery_step
+            if overdue_time >= self.ack_timeout and self.recovery_step == 0:
+                self.recovery_step = 1
+            elif overdue_time >= 2 * self.ack_timeout and self.recovery_step == 1:
+                self.recovery_step = 2
+            elif self.reboot_timeout != None and now - self.last_ack >= self.reboot_timeout and self.recovery_step == 2:
+                self.recovery_step = 3
+            new_step = self.recovery_step != recovery_step
+        if send_heartbeat == True:
+            self.send_heartbeat()
+        if new_step == True:
+            self.metrics.increment('doorbell_heartbeat_recoveries_total', step = self.recovery_step)
+            if self.recovery_step == 1:
+                print("Home Manager heartbeat overdue. Re-establishing the mqtt connection")
+                self.reconnect_mqtt()
+            elif self.recovery_step == 2:
+                print("Home Manager heartbeat still overdue. Restarting the mqtt client and command threads")
+                self.restart_components()
+            elif self.recovery_step == 3:
+                print("Home Manager heartbeat lost for " + str(round(now - self.last_ack)) + " seconds. Rebooting")
+                self.restart_code()
+
+    def seconds_since_ack(self):
+        return time.monotonic() - self.last_ack
+
+class MqttConnection(object): # The class for the mqtt connection. Door stations share the connection and each station's commands are routed to it by topic
+    def __init__(self, client, broker = "<mqtt broker name>", reconnect_max_delay = 30, reconnect_interval = 5, connection_listener = None):
+        self.client = client
+        self.broker = broker
+        self.connection_listener = connection_listener # Told of connections and disconnections before the stations, e.g. the process-wide supervisor
+        self.stations = {} # command topic: station
+        self.stations_lock = Lock()
+        self.reconnect_lock = Lock()
+        self.reconnect_interval = reconnect_interval # Stations that ask for a reconnection within this many seconds of each other share it
+        self.last_reconnect = None
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+        self.client.reconnect_delay_set(min_delay = 1, max_delay = reconnect_max_delay) # The mqtt thread reconnects with backoff after a broker outage
+
+    def add_station(self, command_topic, station): # The station's on_connect, on_disconnect and on_message are called on the mqtt thread
+        with self.stations_lock:
+            self.stations[command_topic] = station
+
+    def remove_station(self, command_topic):
+        with self.stations_lock:
+            self.stations.pop(command_topic, None)
+
+    def station_list(self):
+        with self.stations_lock:
+            return list(self.stations.values())
+
+    def connect(self, blocking = True): # Otherwise the mqtt thread connects in the background
+        if blocking == True:
+            try:
+                self.client.connect(self.broker, 1883, 60) # Connect to mqtt broker
+            except OSError as error: # The mqtt thread keeps trying, so the doorbells still work while the broker is unavailable
+                print("Unable to connect to mqtt server (" + repr(error) + ")")
+                self.on_disconnect(self.client, None, mqtt.MQTT_ERR_NO_CONN)
+                self.client.connect_async(self.broker, 1883, 60)
+        else:
+            self.client.connect_async(self.broker, 1883, 60)
+        self.client.loop_start() # Start mqtt monitor thread
+
+    def on_connect(self, client, userdata, flags, rc):
+        if self.connection_listener != None:
+            self.connection_listener.on_connect(client, userdata, flags, rc)
+        for station in self.station_list():
+            station.on_connect(client, userdata, flags, rc)
+
+    def on_disconnect(self, client, userdata, rc):
+        if self.connection_listener != None:
+            self.connection_listener.on_disconnect(client, userdata, rc)
+        for station in self.station_list():
+            station.on_disconnect(client, userdata, rc)
+
+    def on_message(self, client, userdata, msg):
+        with self.stations_lock:
+            station = self.stations.get(str(msg.topic))
+        if station != None:
+            station.on_message(client, userdata, msg)
+
+    def reconnect(self): # Runs on a supervisor thread. Replaces a connection that may be half open
+        with self.reconnect_lock:
+            if self.last_reconnect != None and time.monotonic() - self.last_reconnect < self.reconnect_interval:
+                return
+            self.reconnect_client()
+
+    def restart(self): # Runs on a supervisor thread. Restarts the mqtt thread as well
+        with self.reconnect_lock:
+            if self.last_reconnect != None and time.monotonic() - self.last_reconnect < self.reconnect_interval:
+                return
+            self.client.loop_stop()
+            self.reconnect_client()
+            self.client.loop_start()
+
+    def reconnect_client(self): # Must be called with reconnect_lock held
+        self.last_reconnect = time.monotonic()
+        try:
+            self.client.reconnect()
+        except OSError as error: # The mqtt thread keeps retrying with backoff
+            print("mqtt reconnection failed with " + repr(error))
+
+    def terminate(self):
+        self.client.loop_stop() # Stop mqtt monitoring thread
+
+class DoorbellServices(object): # The class for the services that door stations share: the mqtt connection, the Pushover notifier, the capture workers,
+    # the event index, the metrics endpoint and the heartbeat supervisor. A single station sets up its own
+    setting_names = ('pushover_token', 'pushover_user', 'pushover_api_url', 'mqtt_broker', 'mqtt_client', 'mqtt_client_id', 'mqtt_reconnect_max_delay',
+                     'event_index_file', 'metrics_port', 'attachment_max_dimension', 'attachment_max_kilobytes', 'heartbeat_enabled', 'heartbeat_interval',
+                     'heartbeat_ack_timeout', 'heartbeat_reboot_timeout', 'metrics_address')
+
+    def __init__(self, pushover_token, pushover_user, pushover_api_url = "https://api.pushover.net/1/messages.json", mqtt_broker = "<mqtt broker name>",
+                 mqtt_client = None, mqtt_client_id = 'doorbell', mqtt_reconnect_max_delay = 30, event_index_file = None, metrics_port = None,
+                 attachment_max_dimension = 1024, attachment_max_kilobytes = 150, heartbeat_enabled = True, heartbeat_interval = 300,
+                 heartbeat_ack_timeout = 150, heartbeat_reboot_timeout = 1800, metrics_address = '127.0.0.1'):
+        if mqtt_client == None:
+            mqtt_client = mqtt.Client(mqtt_client_id) # Create new instance of mqtt Class
+        self.mqtt = MqttConnection(mqtt_client, mqtt_broker, mqtt_reconnect_max_delay, connection_listener = self)
+        # Pictures are downscaled and stripped of metadata on the attachment thread while the rest of the ring sequence runs, so that less is uploaded
+        self.attachments = AttachmentProcessor(attachment_max_dimension, attachment_max_kilobytes * 1000)
+        self.notifier = PushoverNotifier(pushover_token, pushover_user, api_url = pushover_api_url, attachment_processor = self.attachments)
+        self.notifier.start()
+        self.clip_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='clip') # Writes clips and prunes the capture directories after each ring
+        # Each ring is indexed with its station, mode, outcome, captures and notification results, so that Home Manager can query recent rings without the
+        # capture directories being scanned
+        self.event_index = RingEventIndex(event_index_file)
+        self.metrics = MonitorMetrics() # Gauges for the shared services. The stations' metrics are served alongside them
+        self.metrics.add_gauge_source(self.gauge_metrics)
+        self.metrics_list = [self.metrics]
+        self.metrics_port = metrics_port # Port for the Prometheus /metrics endpoint. None disables it
+        self.metrics_address = metrics_address # Only local scrapes by default. '' serves the endpoint on every interface
+        self.metrics_server = None
+        # One supervisor for the process sends the heartbeat on every station's status topic and escalates recovery, up to rebooting the Pi, only while
+        # no station's heartbeat is being acked. The stations' own supervisors only watch their components
+        self.supervisor = MonitorSupervisor(self.metrics, self.send_heartbeat, self.mqtt.reconnect, self.restart_mqtt_components, self.restart_code,
+                                            self.record_event, heartbeat_enabled, heartbeat_interval, heartbeat_ack_timeout, heartbeat_reboot_timeout)
+        self.restart_lock = Lock()
+
+    @classmethod
+    def from_settings(cls, settings, **overrides): # Picks the shared settings out of the monitor settings
+        service_settings = {name: value for name, value in settings.items() if name in cls.setting_names}
+        service_settings.update(overrides)
+        return cls(**service_settings)
+
+    def add_station(self, command_topic, station):
+        self.mqtt.add_station(command_topic, station)
+        self.metrics_list.append(station.metrics)
+
+    def remove_station(self, command_topic):
+        self.mqtt.remove_station(command_topic)
+
+    def start(self, blocking_connect = True): # Called once the stations have been added
+        self.mqtt.connect(blocking_connect)
+        self.supervisor.start()
+        if self.metrics_port != None: # Started last, because scrapes read the gauges of the stations
+            try:
+                self.metrics_server = MetricsHttpServer(self.metrics_list, self.metrics_port, self.metrics_address)
+                self.metrics_server.start()
+            except OSError as error: # e.g. the port is in use. The doorbells still work without the endpoint
+                print("Unable to start the metrics endpoint on " + self.metrics_address + ":" + str(self.metrics_port) + " (" + repr(error) + ")")
+                self.metrics_server = None
+
+    def on_connect(self, client, userdata, flags, rc): # Called on the mqtt thread before the stations are told
+        if rc == 0:
+            self.supervisor.mqtt_connected()
+
+    def on_disconnect(self, client, userdata, rc):
+        if rc != 0: # Not a requested disconnection
+            self.supervisor.mqtt_disconnected()
+
+    def send_heartbeat(self): # Runs on the supervisor thread. An ack on any station's command topic keeps the process running
+        for station in self.mqtt.station_list():
+            station.send_heartbeat_to_home_manager()
+
+    def record_event(self, event_type, **fields): # The recoveries of the shared mqtt connection are recorded in each station's event log
+        for station in self.mqtt.station_list():
+            station.metrics.record(event_type, **fields)
+
+    def restart_mqtt_components(self): # Runs on the supervisor thread
+        for station in self.mqtt.station_list():
+            station.command_dispatcher.start()
+        self.mqtt.restart()
+
+    def restart_code(self): # Every station is shut down before the Pi is rebooted, because they all run on it
+        if self.restart_lock.acquire(blocking = False) == False: # Another station or the supervisor is already restarting
+            return
+        stations = self.mqtt.station_list()
+        for station in stations:
+            station.status_publisher.publish_event('{"service": "Restart"}')
+        for station in stations:
+            station.shutdown_cleanup()
+        if any(station.owns_services == True for station in stations) == False: # A single station terminates its own services
+            self.terminate()
+        os.system('sudo reboot')
+
+    def terminate(self):
+        self.supervisor.terminate()
+        self.notifier.terminate()
+        self.attachments.terminate()
+        self.clip_executor.shutdown(wait=True)
+        self.event_index.terminate()
+        if self.metrics_server != None:
+            self.metrics_server.terminate()
+        self.mqtt.terminate()
+
+    def gauge_metrics(self):
+        notifier_metrics = self.notifier.delivery_metrics()
+        attachment_metrics = self.attachments.processing_metrics()
+        return {('doorbell_seconds_since_heartbeat_ack', ()): self.supervisor.seconds_since_ack(),
+                ('doorbell_mqtt_connected', ()): int(self.supervisor.disconnected_time == None),
+                ('doorbell_notifier_queue_depth', ()): notifier_metrics['Queue Depth'],
+                ('doorbell_notifier_retries', ()): notifier_metrics['Retries'],
+                ('doorbell_notifier_dropped', ()): notifier_metrics['Dropped'],
+                ('doorbell_notifier_upload_bytes', ()): notifier_metrics['Upload Bytes'],
+                ('doorbell_attachments_processed', ()): attachment_metrics['Processed'],
+                ('doorbell_attachment_cache_hits', ()): attachment_metrics['Cache Hits'],
+                ('doorbell_attachment_original_bytes', ()): attachment_metrics['Original Bytes'],
+                ('doorbell_attachment_bytes', ()): attachment_metrics['Attachment Bytes']}
+
+class SimulatedCallController(object): # The class for simulating the Linphone call controller
+    def __init__(self, answer_delay = 2, call_duration = 5, answered = True, start_delay = 0, setup_delay = 0.2):
+        self.answer_delay = answer_delay
+        self.setup_delay = setup_delay # Simulates the time from dialling to the callee's phone ringing
+        self.call_duration = call_duration
+        self.answered = answered
+        self.start_delay = start_delay # Simulates the Linphone start and SIP registration time
+        self.running = False
+        self.process_lock = Lock()
+        self.process_starts = 0 # The number of times Linphone would have been launched
+        self.call_setup_latency = None
+        self.answer_latency = None
+        self.call_times = collections.deque(maxlen=1000)
+        self.hang_up_requested = threading.Event()
+
+    def is_running(self):
+        return self.running
+
+    def start(self, ready_timeout = 5):
+        with self.process_lock:
+            if self.running == False:
+                self.process_starts += 1
+                time.sleep(min(self.start_delay, ready_timeout))
+            self.running = True
+            return True
+
+    def stop(self):
+        with self.process_lock:
+            self.running = False
+
+    def call(self, sip_address, answer_timeout = 30, max_call_duration = 300, call_time_limit = None):
+        self.call_times.append(time.monotonic())
+        if answer_timeout == None:
+            answer_timeout = 30
+        if max_call_duration == None:
+            max_call_duration = 300
+        if call_time_limit != None:
+            max_call_duration = max(min(max_call_duration, call_time_limit - self.answer_delay), 0)
+        self.call_setup_latency = None
+        self.answer_latency = None
+        if self.setup_delay <= min(self.answer_delay, answer_timeout):
+            self.call_setup_latency = self.setup_delay
+        try:
+            if self.answered == False or self.answer_delay > answer_timeout:
+                self.hang_up_requested.wait(answer_timeout)
+                return False
+            if self.hang_up_requested.wait(self.answer_delay) == True:
+                return False
+            self.answer_latency = self.answer_delay
+            self.hang_up_requested.wait(min(self.call_duration, max_call_duration))
+            return True
+        finally:
+            self.hang_up_requested.clear()
+
+    def hang_up(self):
+        self.hang_up_requested.set()
+
+class SimulatedMqttMessage(object):
+    def __init__(self, topic, payload, qos = 0, retain = False):
+        self.topic = topic
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+class SimulatedMqttBroker(object): # The class for an in-process stand-in for the mqtt broker
+    def __init__(self, connect_delay = 0):
+        self.connect_delay = connect_delay # Simulates the time taken to reach the broker, e.g. while the network is coming up after a reboot
+        self.broker_lock = Lock()
+        self.clients = []
+        self.retained_messages = {}
+        self.online = True
+        self.published_messages = collections.deque(maxlen=10000) # (time, client id, topic, payload, retain)
+
+    def client(self, client_id): # Returns a client with the subset of the paho mqtt Client interface that the monitor uses
+        return SimulatedMqttClient(self, client_id)
+
+    def topic_matches(self, subscription, topic):
+        if subscription.endswith('#'):
+            return topic.startswith(subscription[:-1])
+        return subscription == topic
+
+    def route(self, client_id, topic, payload, qos = 0, retain = False):
+        message = SimulatedMqttMessage(topic, payload, qos, retain)
+        with self.broker_lock:
+            if self.online == False:
+                return False
+            self.published_messages.append((time.monotonic(), client_id, topic, message.payload, retain))
+            if retain == True:
+                self.retained_messages[topic] = message
+            subscribers = [client for client in self.clients if client.connected == True and
+                           any(self.topic_matches(subscription, topic) for subscription in client.subscriptions)]
+        for client in subscribers:
+            client.deliver(SimulatedMqttMessage(topic, message.payload, qos, False))
+        return True
+
+    def publish(self, topic, payload, qos = 0, retain = False): # Publishes a message from outside the monitor, e.g. a Home Manager command
+        return self.route('broker', topic, payload, qos, retain)
+
+    def retained_for(self, subscription):
+        with self.broker_lock:
+            return [message for topic, message in self.retained_messages.items() if self.topic_matches(subscription, topic)]
+
+    def stop(self): # Simulates a broker outage. Connected clients are disconnected
+        with self.broker_lock:
+            self.online = False
+            clients = list(self.clients)
+        for client in clients:
+            client.lose_connection()
+
+    def start(self):
+        with self.broker_lock:
+            self.online = True
+
+class SimulatedMqttClient(object): # The class for a client of the simulated mqtt broker. Callbacks run on the client's network thread, as with paho
+    def __init__(self, broker, client_id):
+        self.broker = broker
+        self.client_id = client_id
+        self.on_connect = None
+        self.on_message = None
+        self.on_disconnect = None
+        self.connected = False
+        self.connect_wanted = False
+        self.subscriptions = set()
+        self.network_queue = queue.Queue()
+        self.pending_messages = collections.deque(maxlen=1000) # QoS > 0 messages published while disconnected
+        self.reconnect_min_delay = 1
+        self.reconnect_max_delay = 120
+        self.reconnect_delay = 1 # Doubles after each failed reconnection, as with paho
+        self.network_thread = None
+
+    def connect(self, host, port = 1883, keepalive = 60):
+        self.connect_wanted = True
+        if self.broker.online == False:
+            raise ConnectionRefusedError('Simulated broker offline')
+        self.establish_connection()
+        return 0
+
+    def connect_async(self, host, port = 1883, keepalive = 60):
+        self.connect_wanted = True
+        self.network_queue.put(('Reconnect',))
+
+    def reconnect(self):
+        return self.connect(None)
+
+    def reconnect_delay_set(self, min_delay = 1, max_delay = 120):
+        self.reconnect_min_delay = min_delay
+        self.reconnect_max_delay = max_delay
+        self.reconnect_delay = min_delay
+
+    def establish_connection(self):
+        time.sleep(self.broker.connect_delay)
+        with self.broker.broker_lock:
+            if self.broker.online == False:
+                self.reconnect_delay = min(self.reconnect_delay * 2, self.reconnect_max_delay)
+                return False
+            self.reconnect_delay = self.reconnect_min_delay
+            self.connected = True
+            if self not in self.broker.clients:
+                self.broker.clients.append(self)
+        self.network_queue.put(('Connected',))
+        return True
+
+    def lose_connection(self):
+        if self.connected == True:
+            self.connected = False
+            self.network_queue.put(('Disconnected', 1))
+
+    def disconnect(self):
+        self.connect_wanted = False
+        if self.connected == True:
+            self.connected = False
+            self.network_queue.put(('Disconnected', 0))
+
+    def is_connected(self):
+        return self.connected
+
+    def loop_start(self):
+        if self.network_thread == None:
+            self.network_thread = Thread(target=self.run, name='simulated_mqtt', daemon=True)
+            self.network_thread.start()
+
+    def loop_stop(self):
+        if self.network_thread != None:
+            self.network_queue.put(None)
+            self.network_thread = None
+
+    def subscribe(self, topic, qos = 0):
+        self.subscriptions.add(topic)
+        for message in self.broker.retained_for(topic):
+            self.deliver(SimulatedMqttMessage(message.topic, message.payload, message.qos, True))
+        return (0, 1)
+
+    def publish(self, topic, payload = None, qos = 0, retain = False):
+        if self.connected == False or self.broker.route(self.client_id, topic, payload, qos, retain) == False:
+            if qos > 0:
+                self.pending_messages.append((topic, payload, qos, retain))
+        return None
+
+    def deliver(self, message):
+        self.network_queue.put(('Message', message))
+
+    def run(self): # The simulated network thread
+        while True:
+            try:
+                network_event = self.network_queue.get(timeout = self.reconnect_delay if self.connected == False else None)
+            except queue.Empty:
+                if self.connected == False and self.connect_wanted == True:
+                    self.establish_connection() # Reconnects automatically with backoff, as paho does in its network loop
+                continue
+            if network_event == None:
+                break
+            if network_event[0] == 'Reconnect':
+                if self.establish_connection() == False:
+                    continue
+            elif network_event[0] == 'Connected':
+                while len(self.pending_messages) > 0:
+                    topic, payload, qos, retain = self.pending_messages.popleft()
+                    self.broker.route(self.client_id, topic, payload, qos, retain)
+                if self.on_connect != None:
+                    self.on_connect(self, None, {}, 0)
+            elif network_event[0] == 'Disconnected':
+                if self.on_disconnect != None:
+                    self.on_disconnect(self, None, network_event[1])
+            elif network_event[0] == 'Message' and self.on_message != None:
+                self.on_message(self, None, network_event[1])
 
 class NorthcliffDoorbellMonitor(object): # The class for the main door monitor program
+    default_pins = {'Manual Button': 17, 'Auto Button': 22, 'Doorbell Not Ringing': 24, 'Open Door': 18, 'Manual LED Off': 27, 'Auto LED Off': 21} # BCM numbering
+
     def __init__(self, pushover_in_manual_mode, full_video, ask_for_auto_time_input, active_auto_start, active_auto_finish, disable_weekend,
                  manual_mode_call_sip_address, pushover_token, pushover_user, linphone_debug_log_file, auto_message_file,
-                 auto_video_capture_directory, linphone_config_file, auto_on_startup, linphone_in_manual_mode, heartbeat_enabled):
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setwarnings(False)
+                 auto_video_capture_directory, linphone_config_file, auto_on_startup, linphone_in_manual_mode, heartbeat_enabled,
+                 interrupt_ring_detection = True, pushover_api_url = "https://api.pushover.net/1/messages.json", camera_backend = 'Fswebcam', camera_device = 0,
+                 clip_recording = False, pre_ring_seconds = 3, post_ring_seconds = 5, capture_retention_megabytes = None, capture_retention_days = None,
+                 auto_windows = None, auto_holidays = (), mqtt_qos = 1, status_coalesce_period = 0.2, mqtt_broker = "<mqtt broker name>", pins = None,
+                 door_open_time = 3, gpio = None, mqtt_client = None, camera = None, audio_player = None, sip_controller = None, event_log_file = None,
+                 metrics_port = None, metrics_publish_period = 60, event_index_file = None, attachment_max_dimension = 1024,
+                 attachment_max_kilobytes = 150, audio_backend = 'Alsa', audio_device = 'front:CARD=Device,DEV=0', audio_messages = None,
+                 heartbeat_interval = 300, heartbeat_ack_timeout = 150, heartbeat_reboot_timeout = 1800, mqtt_reconnect_max_delay = 30,
+                 main_loop_stall_timeout = 120, station_name = None, topic_prefix = 'Doorbell', services = None, fast_start = False,
+                 metrics_address = '127.0.0.1'):
+        # Set up the station. Stations in the same process share their services and are told apart by their name and mqtt topics
+        self.station_name = station_name # None for a single station
+        self.command_topic = topic_prefix + 'Button'
+        self.status_topic = topic_prefix + 'Status'
+        self.metrics_topic = topic_prefix + 'Metrics'
+        self.events_topic = topic_prefix + 'Events'
+        # A single station has the mqtt connection, notifier, capture workers, event index and metrics endpoint to itself. Their settings are otherwise
+        # taken from the shared services
+        self.owns_services = services == None
+        if self.owns_services == True:
+            services = DoorbellServices(pushover_token, pushover_user, pushover_api_url, mqtt_broker, mqtt_client, 'doorbell', mqtt_reconnect_max_delay,
+                                        event_index_file, metrics_port, attachment_max_dimension, attachment_max_kilobytes, heartbeat_enabled,
+                                        heartbeat_interval, heartbeat_ack_timeout, heartbeat_reboot_timeout, metrics_address)
+        self.services = services
+        # Fast start mode brings up ring detection and door control first. mqtt, the camera warm-up, message loading and the Linphone test call then
+        # carry on in the background. The time that each part takes to be ready is reported
+        self.fast_start = fast_start
+        self.startup_time = time.monotonic()
+        self.readiness = {} # Component: (ready, seconds after startup)
+        self.readiness_lock = Lock()
+        self.startup_test_call_lock = Lock() # Stops a ring and the startup test call from being handled at the same time
+        self.startup_test_call_active = False
+        # Set up the hardware backends. The simulated backends allow the monitor to be run and benchmarked off the Pi
+        if gpio == None:
+            gpio = raspberry_pi_gpio()
+        self.gpio = gpio
+        self.pins = dict(self.default_pins)
+        if pins != None:
+            self.pins.update(pins)
+        self.gpio.setmode(self.gpio.BCM)
+        self.gpio.setwarnings(False)
+        self.leds = None # The LEDs are set up when the monitor is run
         # Set up the non-LED GPIO ports
-        self.manual_button = 17
-        self.auto_button = 22
-        self.door_bell_not_ringing = 24
-        self.open_door = 18
-        GPIO.setup(self.door_bell_not_ringing, GPIO.IN)
-        GPIO.setup(self.open_door, GPIO.OUT)
-        GPIO.setup(self.manual_button, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-        GPIO.setup(self.auto_button, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-        GPIO.add_event_detect(self.manual_button, GPIO.RISING, self.process_manual_button, bouncetime=300)
-        GPIO.add_event_detect(self.auto_button, GPIO.RISING, self.process_auto_button, bouncetime=300)
-        # Set up status flags
-        self.idle_mode_enabled = True
-        self.manual_mode_enabled = False
-        self.auto_mode_enabled = False
+        self.manual_button = self.pins['Manual Button']
+        self.auto_button = self.pins['Auto Button']
+        self.door_bell_not_ringing = self.pins['Doorbell Not Ringing']
+        self.open_door = self.pins['Open Door']
+        self.door_open_time = door_open_time
+        self.gpio.setup(self.door_bell_not_ringing, self.gpio.IN)
+        self.gpio.setup(self.open_door, self.gpio.OUT)
+        self.gpio.setup(self.manual_button, self.gpio.IN, pull_up_down=self.gpio.PUD_DOWN)
+        self.gpio.setup(self.auto_button, self.gpio.IN, pull_up_down=self.gpio.PUD_DOWN)
+        self.gpio.add_event_detect(self.manual_button, self.gpio.RISING, self.process_manual_button, bouncetime=300)
+        self.gpio.add_event_detect(self.auto_button, self.gpio.RISING, self.process_auto_button, bouncetime=300)
+        # Set up the instrumentation. Each ring stage is recorded as a timed span in the event log and the latency histograms
+        station_labels = None
+        if self.station_name != None:
+            station_labels = {'station': self.station_name}
+        self.metrics = MonitorMetrics(event_log_file, constant_labels = station_labels) # Door stations are given their own event_log_file
+        self.metrics.add_gauge_source(self.gauge_metrics)
+        self.metrics.start()
+        self.ring_context = threading.local() # Holds the ring id on the ring worker, so that stages shared with mqtt commands are only counted against rings
+        self.metrics_publish_period = metrics_publish_period # Seconds between publications on the metrics mqtt topic. None disables them
+        self.next_metrics_publish = None
+        # Set up the event queue. Button presses, ring edges and mqtt commands are queued as events and processed by the state machine in run()
+        self.event_queue = queue.Queue()
+        self.loop_period = 0.1 # Main loop period. Events wake the loop immediately rather than waiting for the period to expire
+        # Set up doorbell ring detection. Interrupt mode queues ring edges as events. Polling mode is kept as a fallback
+        self.interrupt_ring_detection = interrupt_ring_detection
+        if self.interrupt_ring_detection == True:
+            self.gpio.add_event_detect(self.door_bell_not_ringing, self.gpio.FALLING, self.process_doorbell_ring, bouncetime=300)
+        self.doorbell_input_level = True # The last polled level of the active low doorbell not ringing input
+        # Set up the ring handling pipeline. Ring sequences run one at a time on the ring worker so that the main loop stays responsive.
+        # Pushover uploads are queued to the notifier thread so that they overlap with message playback and door unlocking
+        self.ring_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ring')
+        self.ring_sequence = None
+        self.door_lock = Lock() # Stops an mqtt Open Door command and an auto mode ring from operating the door at the same time
+        # Set up the state machine. The state, triggered flag and auto possible flag are only changed together by process_event()
+        self.state_lock = threading.RLock()
+        self.state = 'Idle' # Idle, Manual, Auto, Auto Out Of Hours (manual answer because auto isn't possible) or Shutdown
+        self.state_time = datetime.now()
         self.triggered = False
-        self.shutdown = False
-        self.ringing = False
+        self.current_auto_possible = False
+        self.transition_history = collections.deque(maxlen=20) # (time, previous state, event, next state)
+        self.transition_table = self.build_transition_table()
         # Set up pushover and linphone
         self.manual_mode_call_sip_address = manual_mode_call_sip_address
         self.pushover_token = pushover_token
         self.pushover_user = pushover_user
+        self.notifier = self.services.notifier
         self.linphone_debug_log_file = linphone_debug_log_file
         self.auto_message_file = auto_message_file
         self.auto_video_capture_directory = auto_video_capture_directory
+        self.capture_file_prefix = '' # Stations that share their services, and usually the capture directory, have their topic prefix in their file names
+        if self.owns_services == False:
+            self.capture_file_prefix = topic_prefix
+        # Set up the camera. The buffered camera keeps the video device open so that the picture is taken at the ring edge. fswebcam is the fallback
+        if camera_backend == 'Buffered' and cv2 == None:
+            print("OpenCV is not installed. Using fswebcam for picture capture")
+            camera_backend = 'Fswebcam'
+        # Clip recording keeps enough frames buffered to cover the time before and after the ring
+        self.pre_ring_seconds = pre_ring_seconds
+        self.post_ring_seconds = post_ring_seconds
+        buffer_seconds = 5
+        if clip_recording == True:
+            buffer_seconds = max(buffer_seconds, pre_ring_seconds + post_ring_seconds + 1)
+        if camera != None:
+            self.camera = camera
+        elif camera_backend == 'Buffered' and clip_recording == True: # Every frame may end up in a clip, so the frames are encoded as they're read
+            self.camera = BufferedCamera(OpenCvFrameSource(camera_device, encode_frames = True), buffer_seconds)
+        elif camera_backend == 'Buffered': # Only the frames around the ring edge are needed, so a short buffer of raw frames is kept
+            self.camera = BufferedCamera(OpenCvFrameSource(camera_device), 1)
+        elif camera_backend == 'Fake':
+            self.camera = BufferedCamera(FakeFrameSource(), buffer_seconds)
+        else:
+            self.camera = FswebcamCamera()
+        self.camera.start()
+        self.clip_recording = clip_recording
+        if self.clip_recording == True and isinstance(self.camera, BufferedCamera) == False:
+            print("Clip recording requires a buffered camera. Clip recording disabled")
+            self.clip_recording = False
+        self.clip_executor = self.services.clip_executor # Writes clips and prunes the capture directory after each ring
+        self.last_clip_job = None
+        self.event_index = self.services.event_index
+        self.capture_retention = CaptureRetention(auto_video_capture_directory, capture_retention_megabytes, capture_retention_days,
+                                                  self.event_index.remove_files)
         self.linphone_config_file = linphone_config_file
         self.ask_for_auto_time_input = ask_for_auto_time_input
         self.pushover_in_manual_mode = pushover_in_manual_mode
@@ -99,378 +2327,793 @@ class NorthcliffDoorbellMonitor(object): # The class for the main door monitor p
             print("Full Video Mode")
         else:
             self.linphone_video_parameter = "C" # Capture-only Video Mode
-        # Set up auto start and finish times
-        if self.ask_for_auto_time_input == False:
-            self.active_auto_start = active_auto_start
-            self.active_auto_finish = active_auto_finish
-            self.disable_weekend = disable_weekend
-        # Set up mqtt comms
-        self.client = mqtt.Client('doorbell') # Create new instance of mqtt Class
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
-        self.client.connect("<mqtt broker name>", 1883, 60) # Connect to mqtt broker
-        self.client.loop_start() # Start mqtt monitor thread
+        # Set up the auto answer schedule. auto_windows allows minute resolution and several windows per day. Otherwise the hourly settings are used
+        self.auto_holidays = auto_holidays
+        if auto_windows != None:
+            self.auto_schedule = AutoAnswerSchedule(auto_windows, auto_holidays)
+        elif self.ask_for_auto_time_input == False or self.fast_start == True: # In fast start mode, the hourly settings apply until the times have been entered
+            self.auto_schedule = AutoAnswerSchedule(AutoAnswerSchedule.hourly_windows(active_auto_start, active_auto_finish, disable_weekend), auto_holidays)
+        self.next_schedule_change = None
+        # Set up mqtt comms. The station's commands are routed to it by the shared mqtt connection
+        self.mqtt = self.services.mqtt
+        self.client = self.mqtt.client
+        self.command_dispatcher = MqttCommandDispatcher(self.build_mqtt_commands())
+        self.command_dispatcher.start()
+        self.status_publisher = StatusPublisher(self.client, self.status_topic, mqtt_qos, status_coalesce_period)
+        # Set up the station's watchdog, which restarts its stopped components. The heartbeat and mqtt recovery are supervised by the shared services
+        self.supervisor = MonitorSupervisor(self.metrics, heartbeat_enabled = False)
+        self.main_loop_stall_timeout = main_loop_stall_timeout
+        self.main_loop_checked = time.monotonic()
+        self.services.add_station(self.command_topic, self)
         self.disable_doorbell_ring_sensor = False # Enable doorbell ring sensor
         self.entry_door_open = False
-        self.heartbeat_count = 0
-        self.no_heartbeat_ack = False
-        self.linphone_active = False
+        if sip_controller == None:
+            sip_controller = LinphoneCallController(self.linphone_video_parameter, self.linphone_debug_log_file, self.linphone_config_file)
+        self.sip_controller = sip_controller
+        # Set up message playback. Messages are decoded once at startup and played from memory. The audio_messages rules are checked in order and the
+        # first rule for the mode whose windows are active chooses the message. The auto message is played in auto mode if no rule matches
+        self.message_rules = []
+        if audio_messages != None:
+            for message_rule in audio_messages:
+                message_schedule = None
+                if message_rule.get('windows') != None:
+                    message_schedule = AutoAnswerSchedule(message_rule['windows'], message_rule.get('holidays', ()))
+                self.message_rules.append((message_rule.get('modes'), message_schedule, message_rule['file']))
+        self.message_rules.append((['Auto'], None, self.auto_message_file))
+        if audio_player == None:
+            if audio_backend == 'Alsa' and alsaaudio == None:
+                print("alsaaudio is not installed. Using aplay for message playback")
+                audio_backend = 'Aplay'
+            if audio_backend == 'Alsa':
+                audio_player = CachedAudioPlayer(AlsaAudioOutput(audio_device))
+            elif audio_backend == 'Null':
+                audio_player = CachedAudioPlayer(NullAudioOutput())
+            else:
+                audio_player = CachedAudioPlayer(AplayAudioOutput(audio_device))
+        self.audio_player = audio_player
+        if self.fast_start == False: # Otherwise loaded in the background
+            self.load_messages()
+        if self.owns_services == True: # Connects to mqtt and starts the metrics endpoint. Shared services are started once all of the stations are set up
+            self.services.start(blocking_connect = self.fast_start == False)
 
     def on_connect(self, client, userdata, flags, rc):
-        time.sleep(1)
         self.print_status("Connected to mqtt server with result code "+str(rc)+" on ")
-        self.client.subscribe('DoorbellButton')
-        
-    def on_message(self, client, userdata, msg): #Process mqtt messages
-        decoded_payload = str(msg.payload.decode('utf-8'))
-        parsed_json = json.loads(decoded_payload)
-        #print(parsed_json)
-        if str(msg.topic) == 'DoorbellButton':
-            if parsed_json['service'] == 'Automatic':
-                self.process_auto_button(self.auto_button)
-            elif parsed_json['service'] == 'Manual':
-                self.process_manual_button(self.manual_button)
-            elif parsed_json['service'] == 'Open Door':
-                self.open_and_close_door()
-            elif parsed_json['service'] == 'Update Status':
-                self.update_status()
-            elif parsed_json['service'] == 'Door Status Change':
-                self.process_door_status_change(parsed_json)
-            elif parsed_json['service'] == 'Heartbeat Ack':
-                self.heartbeat_ack()
-            else:
-                print('invalid button')
+        if rc == 0:
+            self.client.subscribe(self.command_topic)
+            self.component_ready('mqtt')
+            self.status_publisher.republish() # Refreshes the retained status in case it was lost while disconnected
+
+    def on_disconnect(self, client, userdata, rc):
+        if rc != 0: # Not a requested disconnection
+            self.print_status("Disconnected from mqtt server with result code " + str(rc) + " on ")
+
+    def on_message(self, client, userdata, msg): #Process mqtt messages. Commands are queued so that the mqtt thread is never blocked
+        if str(msg.topic) == self.command_topic:
+            self.command_dispatcher.dispatch(msg.payload)
+
+    def build_mqtt_commands(self): # The mqtt command table. Maps each service to its required fields, its handler and whether it's slow
+        return {'Automatic': ({}, self.process_automatic_command, False),
+                'Manual': ({}, self.process_manual_command, False),
+                'Open Door': ({}, self.process_open_door_command, True),
+                'Update Status': ({}, self.process_update_status_command, False),
+                'Door Status Change': ({'door': str, 'new_door_state': int}, self.process_door_status_change_command, False),
+                'Heartbeat Ack': ({}, self.process_heartbeat_ack_command, False),
+                'Send Metrics': ({}, self.process_send_metrics_command, False),
+                'Query Events': ({}, self.process_query_events_command, True)}
+
+    def process_automatic_command(self, parsed_json):
+        self.post_event('Auto Button')
+
+    def process_manual_command(self, parsed_json):
+        self.post_event('Manual Button')
+
+    def process_open_door_command(self, parsed_json):
+        self.open_and_close_door()
+
+    def process_update_status_command(self, parsed_json):
+        self.update_status(force = True)
+
+    def process_send_metrics_command(self, parsed_json):
+        self.publish_metrics()
+
+    def process_query_events_command(self, parsed_json): # Optional since, until, mode, door_opened, station, limit and request_id fields.
+        # The response is published on the events topic. Only the station's own rings are returned unless station is 'All'
+        response = {'service': 'Event Query Result', 'request_id': parsed_json.get('request_id')}
+        try:
+            door_opened = parsed_json.get('door_opened')
+            if door_opened != None:
+                door_opened = int(bool(door_opened))
+            station = parsed_json.get('station', self.station_name)
+            if station == 'All':
+                station = None
+            response['events'] = self.event_index.query(parsed_json.get('since'), parsed_json.get('until'), parsed_json.get('mode'), door_opened,
+                                                        int(parsed_json.get('limit', 20)), station = station)
+        except Exception as error: # The query fields come from the mqtt payload, so a bad field is reported back rather than raised
+            response['error'] = repr(error)
+        self.client.publish(self.events_topic, json.dumps(response), qos = self.status_publisher.qos)
+
+    def process_door_status_change_command(self, parsed_json):
+        if parsed_json['door'] == 'Entry Door':
+            self.post_event('Entry Door Change', parsed_json['new_door_state'] == 1)
+
+    def process_heartbeat_ack_command(self, parsed_json):
+        self.heartbeat_ack()
+
+    def post_event(self, event, *event_args): # Queues an event for the state machine. Safe to call from any thread
+        self.event_queue.put((event, event_args))
+
+    def process_doorbell_ring(self, channel): # Doorbell ring edge interrupt. Only timestamps and queues the ring so that the GPIO callback thread isn't blocked
+        if self.disable_doorbell_ring_sensor == False:
+            self.post_event('Ring', time.monotonic())
 
     def process_manual_button(self, channel):
         self.print_status("Manual Button Pressed on ")
-        self.triggered =  False
-        self.ringing = False
-        if self.manual_mode_enabled == False:
-            self.idle_mode_enabled = False
-            self.manual_mode_enabled = True
-            self.auto_mode_enabled = False
-            self.manual_mode_startup(normal_manual_flash = True)
-        else:
-            self.manual_mode_enabled = False
-            self.idle_mode_enabled = True
-            self.idle_mode_startup()
+        self.post_event('Manual Button')
                 
     def process_auto_button(self, channel):
         self.print_status("Auto Button Pressed on ")
-        self.triggered = False
-        self.ringing = False
-        if self.auto_mode_enabled == False:
-            self.idle_mode_enabled = False
-            self.auto_mode_enabled = True
-            self.manual_mode_enabled = False
-            self.auto_mode_attempt = True
+        self.post_event('Auto Button')
+
+    def build_transition_table(self): # Precomputes the (state, event, auto possible) -> (next state, triggered, auto possible, action) table.
+        # A triggered or auto possible value of None leaves that flag unchanged. An action of None means that there's nothing to do
+        transition_table = {}
+        answer_states = ('Manual', 'Auto', 'Auto Out Of Hours')
+        for auto_possible in (True, False):
+            if auto_possible == True:
+                auto_state, auto_startup = 'Auto', self.auto_mode_startup
+            else:
+                auto_state, auto_startup = 'Auto Out Of Hours', self.auto_out_of_hours_startup
+            for state in ('Idle',) + answer_states:
+                if state == 'Manual':
+                    transition_table[(state, 'Manual Button', auto_possible)] = ('Idle', False, None, self.idle_mode_startup)
+                else:
+                    transition_table[(state, 'Manual Button', auto_possible)] = ('Manual', False, None, self.manual_mode_startup)
+                if state in ('Auto', 'Auto Out Of Hours'):
+                    transition_table[(state, 'Auto Button', auto_possible)] = ('Idle', False, None, self.idle_mode_startup)
+                else:
+                    transition_table[(state, 'Auto Button', auto_possible)] = (auto_state, False, None, auto_startup)
+                for event, new_auto_possible in (('Auto Possible', True), ('Auto Not Possible', False)):
+                    if state in ('Auto', 'Auto Out Of Hours') and new_auto_possible == True:
+                        transition_table[(state, event, auto_possible)] = ('Auto', None, True, self.auto_mode_startup)
+                    elif state in ('Auto', 'Auto Out Of Hours'):
+                        transition_table[(state, event, auto_possible)] = ('Auto Out Of Hours', None, False, self.auto_out_of_hours_startup)
+                    else:
+                        transition_table[(state, event, auto_possible)] = (state, None, new_auto_possible, self.update_status)
+                if state == 'Idle':
+                    transition_table[(state, 'Ring', auto_possible)] = (state, None, None, self.ring_in_idle_mode)
+                elif state == 'Auto':
+                    transition_table[(state, 'Ring', auto_possible)] = (state, True, None, self.ring_in_auto_mode)
+                else:
+                    transition_table[(state, 'Ring', auto_possible)] = (state, True, None, self.ring_in_manual_mode)
+                transition_table[(state, 'Shutdown', auto_possible)] = ('Shutdown', False, None, None)
+            transition_table[('Shutdown', 'Shutdown', auto_possible)] = ('Shutdown', False, None, None)
+        return transition_table
+
+    def process_event(self, event, *event_args): # Applies the event's state transition atomically and then runs the transition's action
+        with self.state_lock:
+            transition = self.transition_table.get((self.state, event, self.current_auto_possible))
+            if transition == None:
+                print("Event " + event + " ignored in " + self.state + " state")
+                return
+            next_state, triggered, auto_possible, action = transition
+            previous_state = self.state
+            self.state = next_state
+            if triggered != None:
+                self.triggered = triggered
+            if auto_possible != None:
+                self.current_auto_possible = auto_possible
+            if next_state != previous_state:
+                self.state_time = datetime.now()
+                self.transition_history.append((self.state_time, previous_state, event, next_state))
+                print(previous_state + " -> " + next_state + " on " + event + " at " + self.state_time.strftime('%H:%M:%S.%f')[:-3])
+                self.metrics.record('Transition', From = previous_state, To = next_state, Cause = event)
+        if action != None:
+            action(*event_args)
+
+    @property
+    def idle_mode_enabled(self):
+        return self.state == 'Idle'
+
+    @property
+    def manual_mode_enabled(self):
+        return self.state == 'Manual'
+
+    @property
+    def auto_mode_enabled(self):
+        return self.state in ('Auto', 'Auto Out Of Hours')
+
+    @property
+    def shutdown(self):
+        return self.state == 'Shutdown'
+
+    def process_door_status_change(self, door_open):
+        self.entry_door_open = door_open
+        if door_open == True:
+            self.print_status("Entry Door Opened. Automatic Answer Not Possible on ")
         else:
-            self.auto_mode_enabled = False
-            self.idle_mode_enabled = True
-            self.idle_mode_startup()
+            self.print_status("Entry Door Closed. Automatic Answer Now Possible if in hours on ")
+        self.update_auto_possible()
+        self.update_status()
 
-    def process_door_status_change(self, parsed_json):
-        if parsed_json['door'] == 'Entry Door':
-            if parsed_json['new_door_state'] == 1: # If the door is now open
-                self.entry_door_open = True
-                self.print_status("Entry Door Opened. Automatic Answer Not Possible on ")
-            else: # If the door is now closed
-                self.entry_door_open = False
-                self.print_status("Entry Door Closed. Automatic Answer Now Possible if in hours on ")
-            self.update_status()
+    def update_auto_possible(self): # Raises an event if auto answer has become possible or not possible
+        self.next_schedule_change = self.auto_schedule.next_transition()
+        auto_possible = self.auto_possible()
+        if auto_possible != self.current_auto_possible:
+            if auto_possible == True:
+                self.process_event('Auto Possible')
+            else:
+                self.process_event('Auto Not Possible')
 
     def heartbeat_ack(self):
         #self.print_status('Heartbeat received from Home Manager on ')
-        self.heartbeat_count = 0
-        self.no_heartbeat_ack = False
+        self.services.supervisor.heartbeat_ack()
 
-    def update_status(self): #Send status to Homebridge Manager
-        self.status = json.dumps({'service': 'Status Update', 'Idle': self.idle_mode_enabled, 'Automatic': self.auto_mode_enabled, 'Auto Possible': self.auto_possible(), 'Manual': self.manual_mode_enabled,
-                                  'Triggered': self.triggered, 'Terminated': self.shutdown, 'Ringing': self.ringing})
-        self.client.publish("DoorbellStatus", self.status)
+    def update_status(self, ringing = False, force = False): #Send status to Homebridge Manager
+        with self.state_lock: # Takes a consistent snapshot of the state
+            self.status = json.dumps({'service': 'Status Update', 'Idle': self.idle_mode_enabled, 'Automatic': self.auto_mode_enabled, 'Auto Possible': self.current_auto_possible,
+                                      'Manual': self.manual_mode_enabled, 'Triggered': self.triggered, 'Terminated': self.shutdown, 'Ringing': ringing})
+        if ringing == True: # The ringing pulse is published straight away and isn't retained, so that it isn't replayed to Home Manager on reconnection
+            self.status_publisher.publish_event(self.status)
+        else:
+            self.status_publisher.publish_status(self.status, force)
         
-    def print_status(self, print_message):
+    def publish_metrics(self): # Publishes the metrics snapshot, with the shared services' gauges, on the metrics topic. Not retained, because it's stale
+        # by the time anyone reconnects
+        snapshot = self.metrics.snapshot()
+        snapshot['Gauges'].update(self.services.metrics.snapshot()['Gauges'])
+        self.client.publish(self.metrics_topic, json.dumps(snapshot), qos = 0)
+
+    def gauge_metrics(self): # Read from the other components when the metrics are scraped or published
+        command_metrics = self.command_dispatcher.latency_metrics()
+        gauges = {('doorbell_state', (('state', self.state),)): 1,
+                  ('doorbell_command_queue_depth', ()): command_metrics['Queue Depth'],
+                  ('doorbell_commands_rejected', ()): command_metrics['Rejected']}
+        with self.readiness_lock:
+            for component, (ready, seconds) in self.readiness.items():
+                gauges[('doorbell_component_ready', (('component', component),))] = int(ready)
+        for service, metrics in command_metrics.items():
+            if isinstance(metrics, dict):
+                gauges[('doorbell_commands_handled', (('service', service),))] = metrics['Count']
+                gauges[('doorbell_command_queue_seconds_max', (('service', service),))] = metrics['Max Queue Latency']
+                gauges[('doorbell_command_execution_seconds_max', (('service', service),))] = metrics['Max Execution Latency']
+        for result, count in self.status_publisher.publish_counts.items():
+            gauges[('doorbell_status_messages', (('result', result),))] = count
+        if self.leds != None:
+            led_metrics = self.leds.wakeup_metrics()
+            gauges[('doorbell_led_wakeups_per_second', ())] = led_metrics['Wakeups Per Second']
+            gauges[('doorbell_led_gpio_writes_per_second', ())] = led_metrics['GPIO Writes Per Second']
+        return gauges
+
+    def print_status(self, print_message): # Prints the message for the console and records it in the event log
         today = datetime.now()
-        print(print_message + today.strftime('%A %d %B %Y @ %H:%M:%S'))
+        if self.station_name != None:
+            print(self.station_name + ": " + print_message + today.strftime('%A %d %B %Y @ %H:%M:%S'))
+        else:
+            print(print_message + today.strftime('%A %d %B %Y @ %H:%M:%S'))
+        self.metrics.record('Status', Message = print_message.strip())
 
     def input_auto_mode_times(self):
-        self.active_auto_start = int(input("Enter the 'Auto Answer Start Hour' in 24 hour format: "))
-        self.active_auto_finish = int(input("Enter the 'Auto Answer Finish Hour' in 24 hour format: "))
+        active_auto_start = int(input("Enter the 'Auto Answer Start Hour' in 24 hour format: "))
+        active_auto_finish = int(input("Enter the 'Auto Answer Finish Hour' in 24 hour format: "))
         weekday_only = input("Disable Auto Mode on weekends? (y/n): ")
         if weekday_only == "y":
-            self.disable_weekend = True
+            disable_weekend = True
         else:
-            self.disable_weekend = False
+            disable_weekend = False
+        self.auto_schedule = AutoAnswerSchedule(AutoAnswerSchedule.hourly_windows(active_auto_start, active_auto_finish, disable_weekend), self.auto_holidays)
+
+    def input_auto_mode_times_in_background(self): # Used in fast start mode, so that the doorbell is monitored while waiting for the input
+        self.input_auto_mode_times()
+        self.post_event('Schedule Change')
                     
     def idle_mode_startup(self):
-        self.flash_leds.manual_led_on_count = 1 # Short LED Flash
-        self.flash_leds.auto_led_on_count = 1 # Short LED Flash
-        self.flash_leds.led_counter = 0
-        self.idle_mode_enabled = True
-        if self.linphone_in_manual_mode == True and self.linphone_active == True:
-            self.stop_linphone()
+        self.leds.set_patterns('Blip', 'Blip') # Short LED Flashes
         self.print_status("Doorbell Monitor Idle on ")
         self.update_status()
 
     def auto_mode_startup(self):
-        self.flash_leds.manual_led_on_count = 0 # LED Off
         if self.triggered == False:
-            self.flash_leds.auto_led_on_count = 20 # LED On
+            self.leds.set_patterns('Off', 'On') # Auto LED On
         else:
-            self.flash_leds.auto_led_on_count = 10 # 50% LED Flash
-        self.flash_leds.led_counter = 0
+            self.leds.set_patterns('Off', 'Flash') # 50% Auto LED Flash
         self.print_status("Doorbell Monitor Auto Answer on ")
-        if self.linphone_in_manual_mode == True and self.linphone_active == True:
-            self.stop_linphone()
         self.update_status()
 
-    def manual_mode_startup(self, normal_manual_flash):
+    def auto_out_of_hours_startup(self):
+        self.manual_mode_startup(normal_manual_flash = False) # Change LED Flashing in manual_mode_startup to indicate that auto has been disabled due to out of hours or door opening
+
+    def manual_mode_startup(self, normal_manual_flash = True):
         if self.triggered == False:
-            self.flash_leds.manual_led_on_count = 20 # LED On to show that Manual Mode has been set up and has not been triggered
+            manual_pattern = 'On' # LED On to show that Manual Mode has been set up and has not been triggered
         else:
-            self.flash_leds.manual_led_on_count = 10 # 50% LED Flash if the doorbell has been triggered
+            manual_pattern = 'Flash' # 50% LED Flash if the doorbell has been triggered
         if normal_manual_flash == True: # Manual Mode has been invoked through setting manual mode (rather than because the hours are outside auto being possible)
-            self.flash_leds.auto_led_on_count = 0 # LED Off
+            auto_pattern = 'Off'
         else: # Manual Mode has been invoked in out of hours auto mode
-            self.flash_leds.auto_led_on_count = 1 # Short LED Flash to indicate that it's in manual mode because the time is outside auto being possible
-        self.flash_leds.led_counter = 0
+            auto_pattern = 'Blip' # Short LED Flash to indicate that it's in manual mode because the time is outside auto being possible
+        self.leds.set_patterns(manual_pattern, auto_pattern)
         self.print_status("Doorbell Monitor Manual Answer on ")
         if self.linphone_in_manual_mode == True:
-            self.start_linphone()
+            self.restart_linphone_in_background()
         self.update_status()
         
-    def idle_mode(self):
-        if GPIO.input(self.door_bell_not_ringing) == False and self.disable_doorbell_ring_sensor == False: #if the doorbell is rung and not disabled
-            self.print_status("Someone rang the bell on ")
-            self.ringing = True
-            print("Updating Ring Status True")
-            self.update_status()
-            self.ringing = False
-            time.sleep(2.5)
-            self.capture_video()
-            self.push_picture = True # Attach a picture
-            self.send_pushover_message(self.pushover_token, self.pushover_user, "Doorbell is ringing while in idle mode", "magic")
-            self.update_status()
+    def doorbell_ringing(self): # Polling fallback ring detection. Only the falling edge counts as a ring, as in interrupt mode, so a held ring is one ring
+        input_level = self.gpio.input(self.door_bell_not_ringing)
+        ring_started = self.doorbell_input_level == True and input_level == False
+        self.doorbell_input_level = input_level
+        return ring_started == True and self.disable_doorbell_ring_sensor == False
+
+    def log_ring_latency(self, ring_time):
+        self.ring_handler_time = time.monotonic() # When the handler started, so that the time from the ring edge can be measured, e.g. by the benchmark
+        self.ring_latency = self.ring_handler_time - ring_time
+        self.metrics.observe('doorbell_ring_detection_seconds', self.ring_latency)
+        print("Ring handler started " + str(round(self.ring_latency * 1000, 1)) + " ms after ring detection")
+
+    def ring_in_idle_mode(self, ring_time):
+        self.dispatch_ring(self.idle_mode, ring_time)
+
+    def ring_in_auto_mode(self, ring_time):
+        self.leds.set_patterns('Off', 'Flash') # 50% Auto LED Flash
+        self.dispatch_ring(self.auto_mode, ring_time)
+
+    def ring_in_manual_mode(self, ring_time):
+        self.leds.set_patterns(manual_pattern = 'Flash') # 50% Manual LED Flash
+        self.dispatch_ring(self.manual_mode, ring_time)
+
+    def dispatch_ring(self, ring_handler, ring_time): # Sends the ring to the ring worker
+        if self.ring_sequence != None and self.ring_sequence.done() == False:
+            print("Ring ignored because the previous ring is still being handled")
+            self.metrics.increment('doorbell_rings_ignored_total')
+            return
+        ring_wall_time = time.time() - (time.monotonic() - ring_time)
+        ring_id = datetime.fromtimestamp(ring_wall_time).strftime('%Y%m%d%H%M%S%f')[:-3] # Sorts chronologically
+        if self.station_name != None: # Rings at different stations in the same millisecond are indexed separately
+            ring_id += '-' + self.station_name
+        self.metrics.increment('doorbell_rings_total', mode = self.state)
+        self.metrics.record('Ring', Ring = ring_id, Mode = self.state)
+        self.event_index.add_ring(ring_id, ring_wall_time, self.state, self.station_name)
+        with self.startup_test_call_lock:
+            self.ring_sequence = self.ring_executor.submit(self.run_ring_sequence, ring_handler, ring_time, ring_id)
+            end_startup_test_call = self.startup_test_call_active
+        if end_startup_test_call == True: # The ring is queued behind the startup test call, so the call is ended to free Linphone and the camera
+            print("Ending the startup test call for the ring")
+            self.sip_controller.hang_up()
+
+    def run_ring_sequence(self, ring_handler, ring_time, ring_id): # Runs on the ring worker
+        self.ring_context.ring_id = ring_id
+        self.ring_latency = None
+        outcome = 'Completed'
+        try:
+            with self.metrics.span('Ring Sequence', ring_id):
+                ring_handler(ring_time)
+        except Exception as error:
+            outcome = 'Failed'
+            self.print_status("Ring handling failed with " + repr(error) + " on ")
+        finally:
+            self.ring_context.ring_id = None
+            duration = time.monotonic() - ring_time
+            self.metrics.observe('doorbell_ring_to_done_seconds', duration)
+            self.event_index.finish_ring(ring_id, outcome, duration, self.ring_latency)
+
+    def current_ring_id(self): # The ring being handled on this thread or None
+        return getattr(self.ring_context, 'ring_id', None)
+
+    def idle_mode(self, ring_time):
+        self.log_ring_latency(ring_time)
+        self.start_clip_recording(ring_time)
+        self.print_status("Someone rang the bell on ")
+        print("Updating Ring Status True")
+        self.update_status(ringing = True)
+        picture_file_name = self.capture_video(ring_time) # Capture stage
+        self.send_pushover_message("Doorbell is ringing while in idle mode", "magic", picture_file_name) # Notify stage
+        self.play_message('Idle') # Only if there's an idle mode message rule
+        self.update_status()
         
-    def auto_mode(self):
-        if GPIO.input(self.door_bell_not_ringing) == False and self.disable_doorbell_ring_sensor == False: #if the doorbell is rung and not disabled
-            self.flash_leds.manual_led_on_count = 0 # LED Off
-            self.flash_leds.auto_led_on_count = 10 # 50% LED Flash
-            self.flash_leds.led_counter = 0
-            self.print_status("Someone rang the bell while in auto mode on ")
-            self.triggered = True
-            self.ringing = True
-            self.update_status()
-            self.ringing = False
-            time.sleep(2.5)
-            self.capture_video() # Capture picture before door opens
-            self.play_message()
-            self.push_picture = True # Tells Pushover to send a picture
-            self.open_and_close_door()
-            self.send_pushover_message(self.pushover_token, self.pushover_user, "Doorbell is ringing while in auto mode", "updown")
-            self.capture_video() # Capture picture after door opens
-            self.send_pushover_message(self.pushover_token, self.pushover_user, "Second Auto Mode picture capture", "magic")
-            self.update_status()
+    def auto_mode(self, ring_time):
+        self.log_ring_latency(ring_time)
+        self.start_clip_recording(ring_time)
+        self.print_status("Someone rang the bell while in auto mode on ")
+        self.update_status(ringing = True)
+        picture_file_name = self.capture_video(ring_time) # Capture picture before door opens
+        # The first notification is uploaded by the notifier thread while the message plays and the door is unlocked
+        self.send_pushover_message("Doorbell is ringing while in auto mode", "updown", picture_file_name)
+        self.play_message() # Announce stage
+        self.open_and_close_door() # Unlock stage
+        picture_file_name = self.capture_video() # Capture picture after door opens
+        self.send_pushover_message("Second Auto Mode picture capture", "magic", picture_file_name)
+        self.update_status()
             
-    def manual_mode(self):
-        if GPIO.input(self.door_bell_not_ringing) == False and self.disable_doorbell_ring_sensor == False: #if the doorbell is rung and not disabled
-            self.flash_leds.manual_led_on_count = 10 # 50% LED Flash
-            self.flash_leds.led_counter = 0
-            self.print_status("Someone rang the bell while in manual mode on ")
-            self.triggered = True
-            self.ringing = True
-            self.update_status()
-            self.ringing = False
-            time.sleep(2.5)
-            self.capture_video()          
-            if self.linphone_in_manual_mode == True:
-                print("Calling Linphone")
-                subprocess.call(['linphonecsh dial ' + self.manual_mode_call_sip_address], shell=True)
-                time.sleep(30)
-                print("Terminating Linphone call")
-                subprocess.call(["linphonecsh generic 'terminate'"], shell=True) # Terminate linphone call
-            if self.pushover_in_manual_mode == True:
-                print("Sending Pushover Message")
-                self.push_picture = True # Attach a picture
-                self.send_pushover_message(self.pushover_token, self.pushover_user, "Doorbell rang while in manual mode", "bugle")
-            self.update_status()
-
-    def play_message(self):
-        print("Playing message")
-        subprocess.call(['aplay -D front:CARD=Device,DEV=0 ' + self.auto_message_file], shell=True)
-
-    def send_pushover_message(self, token, user, pushed_message, alert_sound):
-        conn = http.client.HTTPSConnection("api.pushover.net:443")
-        if self.push_picture == False: # No picture is to be pushed
-            conn.request("POST", "/1/messages.json",
-             urllib.parse.urlencode({
-                            "token": token,
-                            "user": user,
-                            "html": "1",
-                            "title": "Doorbell",
-                            "message": pushed_message,
-                            "sound": alert_sound,
-                            }), { "Content-type": "application/x-www-form-urlencoded" })
-        else: # Picture is to be pushed
-            r = requests.post("https://api.pushover.net/1/messages.json", data = {
-                            "token": token,
-                            "user": user,
-                            "title": "Doorbell",
-                            "message": pushed_message,
-                            "sound": alert_sound
-            },
-            files = {
-                "attachment": ("image.jpg", open(self.picture_file_name, "rb"), "image/jpeg")
-            })
+    def manual_mode(self, ring_time):
+        self.log_ring_latency(ring_time)
+        self.start_clip_recording(ring_time)
+        self.print_status("Someone rang the bell while in manual mode on ")
+        self.update_status(ringing = True)
+        picture_file_name = self.capture_video(ring_time)
+        if self.pushover_in_manual_mode == True: # The notification is uploaded while the Linphone call is in progress
+            print("Sending Pushover Message")
+            self.send_pushover_message("Doorbell rang while in manual mode", "bugle", picture_file_name)
+        self.play_message('Manual') # Only if there's a manual mode message rule
+        if self.linphone_in_manual_mode == True:
+            print("Calling Linphone")
+            self.camera.pause() # Release the video device for the call
+            with self.metrics.span('Call', self.current_ring_id()):
+                answered = self.sip_controller.call(self.manual_mode_call_sip_address) # Returns when the callee hangs up or the call times out
+            self.record_call_latency()
+            self.metrics.increment('doorbell_calls_total', answered = answered)
+            self.event_index.set_call_answered(self.current_ring_id(), answered)
+            self.camera.resume()
+        self.update_status()
+
+    def record_call_latency(self): # SIP setup, to the callee's phone ringing, is kept apart from the time the callee takes to answer
+        if self.sip_controller.call_setup_latency != None:
+            self.metrics.observe('doorbell_call_setup_seconds', self.sip_controller.call_setup_latency)
+        if self.sip_controller.answer_latency != None:
+            self.metrics.observe('doorbell_call_answer_seconds', self.sip_controller.answer_latency)
+
+    def select_message(self, mode): # Returns the message file of the first matching message rule or None
+        for message_modes, message_schedule, message_file in self.message_rules:
+            if (message_modes == None or mode in message_modes) and (message_schedule == None or message_schedule.is_active() == True):
+                return message_file
+        return None
+
+    def play_message(self, mode = 'Auto'):
+        message_file = self.select_message(mode)
+        if message_file == None:
+            return
+        print("Playing message " + message_file)
+        with self.metrics.span('Announce', self.current_ring_id()):
+            self.audio_player.play(message_file)
+
+    def send_pushover_message(self, pushed_message, alert_sound, picture_file_name = None): # Queues the message on the notifier thread
+        ring_id = self.current_ring_id()
+        start_time = time.time()
+        start = time.monotonic()
+        delivery = self.notifier.send_message(pushed_message, alert_sound, picture_file_name, self.station_name or "Doorbell")
+        delivery.add_done_callback(lambda delivery: self.record_notification(delivery, ring_id, start_time, start, picture_file_name != None))
+        return delivery
+
+    def record_notification(self, delivery, ring_id, start_time, start, picture): # Runs on the notifier thread when the message has been sent or has failed
+        duration = time.monotonic() - start
+        delivered = delivery.result()
+        self.metrics.observe('doorbell_stage_seconds', duration, stage = 'Notify')
+        self.metrics.increment('doorbell_notifications_total', delivered = delivered)
+        if ring_id != None:
+            self.event_index.add_notification(ring_id, delivered)
+        self.metrics.record('Span', Stage = 'Notify', Ring = ring_id, Start = round(start_time, 3), Duration = round(duration, 4),
+                            Outcome = 'OK' if delivered == True else 'Failed', Picture = picture)
             
     def open_and_close_door(self):
-        self.disable_doorbell_ring_sensor = True # To avoid triggering doorbell ring sensor when door is opened and closed
-        GPIO.output(self.open_door, True)
-        self.print_status("Door unlocked on ")
-        time.sleep(3)
-        GPIO.output(self.open_door, False)
-        self.print_status("Door locked on ")
-        self.disable_doorbell_ring_sensor = False # Reactivate doorbell ring sensor
-
-    def capture_video(self):
+        ring_id = self.current_ring_id()
+        self.metrics.increment('doorbell_door_openings_total', source = 'Ring' if ring_id != None else 'Command')
+        if ring_id != None:
+            self.event_index.set_door_opened(ring_id)
+        with self.door_lock, self.metrics.span('Unlock', self.current_ring_id()):
+            self.disable_doorbell_ring_sensor = True # To avoid triggering doorbell ring sensor when door is opened and closed
+            self.gpio.output(self.open_door, True)
+            self.print_status("Door unlocked on ")
+            time.sleep(self.door_open_time)
+            self.gpio.output(self.open_door, False)
+            self.print_status("Door locked on ")
+            self.disable_doorbell_ring_sensor = False # Reactivate doorbell ring sensor
+
+    def start_clip_recording(self, ring_time): # Records the clip and then prunes the capture directory on the clip worker
+        if self.clip_recording == True:
+            time_stamp = datetime.now().strftime('%d%B%Y%H%M%S')
+            clip_file_name = self.auto_video_capture_directory + self.capture_file_prefix + time_stamp + "clipdump.mjpeg"
+            self.last_clip_job = self.clip_executor.submit(self.record_clip, clip_file_name, ring_time, self.current_ring_id())
+        else:
+            self.last_clip_job = self.clip_executor.submit(self.capture_retention.prune)
+        return self.last_clip_job
+
+    def record_clip(self, clip_file_name, ring_time, ring_id = None):
+        print("Recording clip in file " + clip_file_name)
+        clip_recorded = self.camera.record_clip(clip_file_name, ring_time, self.pre_ring_seconds, self.post_ring_seconds)
+        if clip_recorded == True and ring_id != None:
+            self.event_index.add_capture(ring_id, 'Clip', clip_file_name)
+        self.capture_retention.prune()
+        if clip_recorded == False:
+            return None
+        return clip_file_name
+
+    def capture_video(self, ring_time = None): # Captures the picture at the ring time or, if there's no ring time, now
         today = datetime.now()
         time_stamp = today.strftime('%d%B%Y%H%M%S')
-        self.picture_file_name = self.auto_video_capture_directory + time_stamp + "picturedump.jpg"
-        print("Capturing picture in file " + self.picture_file_name)
-        subprocess.call(["fswebcam " + self.picture_file_name], shell=True)
+        picture_file_name = self.auto_video_capture_directory + self.capture_file_prefix + time_stamp + "picturedump.jpg"
+        print("Capturing picture in file " + picture_file_name)
+        with self.metrics.span('Capture', self.current_ring_id()):
+            captured = self.camera.capture(picture_file_name, ring_time)
+        if captured == False:
+            print("Picture capture failed")
+            self.metrics.increment('doorbell_capture_failures_total')
+            return None
+        if self.current_ring_id() != None:
+            self.event_index.add_capture(self.current_ring_id(), 'Photo', picture_file_name)
+        return picture_file_name
          
     def auto_possible(self):
-        today = datetime.now()
-        hour = int(today.strftime('%H'))
-        day = today.strftime('%A')
-        if day == "Saturday" or day == "Sunday":
-            weekday = False
-        else:
-            weekday = True
-        if self.disable_weekend == True and weekday == False:
-            active_day = False
-        else:
-            active_day = True
-        if hour >= self.active_auto_start and hour < self.active_auto_finish and active_day == True and self.entry_door_open == False:
-            return True
-        else:
-            return False
+        return self.auto_schedule.is_active() == True and self.entry_door_open == False
 
     def start_linphone(self):
-        print('Starting Linphone')
-        self.linphone_active = True
-        subprocess.call(['linphonecsh init -' + self.linphone_video_parameter + ' -d 1 -l ' + self.linphone_debug_log_file +
-                         " -c " + self.linphone_config_file], shell=True)
+        return self.sip_controller.start()
 
     def stop_linphone(self):
-        print('Stopping Linphone')
-        self.linphone_active = False
-        subprocess.call(['linphonecsh exit'], shell=True)
+        self.sip_controller.stop()
+
+    def restart_linphone_in_background(self): # Restarts Linphone if it has stopped. Linphone is otherwise kept running between manual mode sessions. The start
+        # runs on its own thread, so that the main loop doesn't wait for SIP registration, and is left to the startup self test until it has run
+        with self.readiness_lock:
+            self_test_started = 'Linphone' in self.readiness
+        if self_test_started == True and self.sip_controller.is_running() == False:
+            Thread(target=self.start_linphone, name='linphone_start', daemon=True).start()
         
     def shutdown_cleanup(self):
-        # Shutdown LED flashing thread
-        self.flash_leds.flash_leds = False
-        self.flash_leds.terminate()
-        GPIO.cleanup()
+        self.supervisor.terminate() # So that the watchdog doesn't restart the components as they're stopped
+        # Shutdown LED thread
+        led_metrics = self.leds.wakeup_metrics()
+        print("LED thread averaged " + str(round(led_metrics['Wakeups Per Second'], 2)) + " wakeups per second")
+        self.leds.terminate()
+        # Stop accepting new rings. Any ring sequence in progress is left to finish
+        self.ring_executor.shutdown(wait=False, cancel_futures=True)
+        if self.startup_test_call_active == True:
+            self.sip_controller.hang_up()
+        self.services.remove_station(self.command_topic)
+        self.command_dispatcher.terminate()
+        if self.last_clip_job != None:
+            self.last_clip_job.exception() # Waits for any clip to be written before the camera is stopped. The clip worker runs the jobs in order
+        self.camera.terminate()
+        self.audio_player.terminate()
+        self.gpio.cleanup([self.pins[pin_name] for pin_name in self.pins]) # Leaves any other stations' pins alone
         if self.linphone_in_manual_mode == True:
             self.stop_linphone()
         time.sleep(1)
         self.today = datetime.now()
         self.print_status("Doorbell Monitor Stopped on ")
-        self.idle_mode_enabled = False
-        self.manual_mode_enabled = False
-        self.auto_mode_enabled = False
-        self.triggered = False
-        self.ringing = False
-        self.shutdown = True
-        self.update_status()
-        self.client.loop_stop() # Stop mqtt monitoring thread
+        self.process_event('Shutdown')
+        self.update_status(force = True)
+        self.publish_metrics()
+        self.metrics.terminate() # Writes the last batch of events
+        if self.owns_services == True:
+            self.services.terminate()
         
-    def process_home_manager_heartbeat(self):
-        if self.heartbeat_enabled == True:
-            self.heartbeat_count +=1
-            if self.heartbeat_count == 3000:
-                #self.print_status('Sending Heartbeat to Home Manager on ')
-                self.send_heartbeat_to_home_manager()
-            if self.heartbeat_count > 4500:
-                self.print_status('Home Manager Heartbeat Lost. Restarting code on ')
-                self.no_heartbeat_ack = True
-                self.shutdown_cleanup()
-                time.sleep(10)
-                self.restart_code()
-            
+    def component_ready(self, component, ready = True): # Records and reports the time from startup until the component was ready. Only the first report counts
+        with self.readiness_lock:
+            if component in self.readiness:
+                return
+            seconds = round(time.monotonic() - self.startup_time, 3)
+            self.readiness[component] = (ready, seconds)
+            readiness = {name: {'Ready': ready, 'Seconds': seconds} for name, (ready, seconds) in self.readiness.items()}
+        if ready == True:
+            self.print_status(component + " ready " + str(seconds) + " seconds after startup on ")
+        else:
+            self.print_status(component + " not ready " + str(seconds) + " seconds after startup on ")
+        self.metrics.observe('doorbell_startup_seconds', seconds, component = component)
+        self.metrics.record('Ready', Component = component, Ready = ready, Seconds = seconds)
+        self.status_publisher.publish_event(json.dumps({'service': 'Readiness', 'Components': readiness})) # Queued by the mqtt client until it's connected
+
+    def load_messages(self): # Decodes the messages so that they're played from memory and opens the audio output for the auto message
+        loaded = True
+        for message_modes, message_schedule, message_file in self.message_rules:
+            if self.audio_player.load(message_file) == False:
+                loaded = False
+        if self.audio_player.prepare(self.auto_message_file) == False:
+            loaded = False
+        self.component_ready('Audio', loaded)
+
+    def warm_up_camera(self): # Waits for the camera to warm up. The startup picture is only taken if there isn't a Linphone test call
+        self.component_ready('Camera', self.camera.wait_for_frame())
+        if self.linphone_in_manual_mode == False:
+            self.capture_video() # Capture picture on startup
+
+    def start_sip_self_test(self, camera_warm_up = None): # Starts Linphone, which is kept running afterwards, and then places the startup test call.
+        # In fast start mode, the test call is queued on the ring worker once the camera has warmed up, so that it's never in the way of a ring
+        self.component_ready('Linphone', self.start_linphone())
+        self.supervisor.add_component('Linphone', self.sip_controller.is_running, self.start_linphone)
+        if camera_warm_up == None:
+            self.place_startup_test_call()
+        else:
+            camera_warm_up.result()
+            try:
+                self.ring_executor.submit(self.place_startup_test_call)
+            except RuntimeError: # The monitor has been stopped
+                pass
+
+    def place_startup_test_call(self):
+        with self.startup_test_call_lock:
+            if self.ring_sequence != None and self.ring_sequence.done() == False: # A ring is waiting on the ring worker, so the test call goes after it
+                try:
+                    self.ring_executor.submit(self.place_startup_test_call)
+                except RuntimeError:
+                    pass
+                return
+            self.startup_test_call_active = True
+        print("Linphone Test Call on Startup")
+        self.camera.pause()
+        try:
+            # The test call is capped at 25 seconds from dialling, as it was before the call controller, whether or not it's answered
+            answered = self.sip_controller.call(self.manual_mode_call_sip_address, answer_timeout = 25, call_time_limit = 25)
+            self.record_call_latency()
+        finally:
+            self.camera.resume()
+            with self.startup_test_call_lock:
+                self.startup_test_call_active = False
+        self.component_ready('SIP Self Test', answered)
+
+    def check_main_loop(self): # The watchdog check for the main loop. Queues a Watchdog event and checks that the previous one was processed in time
+        self.post_event('Watchdog')
+        return time.monotonic() - self.main_loop_checked < self.main_loop_stall_timeout
+
+    def restart_leds(self):
+        self.leds_thread = Thread(target=self.leds.run, name='leds')
+        self.leds_thread.start()
+
+    def main_loop_stalled(self): # Can't be fixed in-process, so this is the last resort
+        self.print_status("Main loop stalled. Restarting code on ")
+        self.restart_code()
+
     def send_heartbeat_to_home_manager(self):
-        self.client.publish('DoorbellStatus', '{"service": "Heartbeat"}')
+        self.status_publisher.publish_event('{"service": "Heartbeat"}')
         
-    def restart_code(self):
-        self.client.publish('DoorbellStatus', '{"service": "Restart"}')
-        self.shutdown_cleanup()
-        os.system('sudo reboot')
+    def restart_code(self): # Reboots the Pi, so every station is shut down
+        self.services.restart_code()
                             
+    def loop_timeout(self): # The loop only needs to wake at the next schedule change or metrics publication, unless polling
+        if self.next_schedule_change == None:
+            timeout = 3600
+        else:
+            timeout = (self.next_schedule_change - self.auto_schedule.clock()).total_seconds()
+        if self.next_metrics_publish != None:
+            timeout = min(timeout, self.next_metrics_publish - time.monotonic())
+        if self.interrupt_ring_detection == False:
+            timeout = min(timeout, self.loop_period)
+        return max(timeout, 0)
+
+    def process_loop_period(self): # Runs at the end of each loop period without an event
+        if self.next_schedule_change != None and self.auto_schedule.clock() >= self.next_schedule_change:
+            self.update_auto_possible()
+        if self.interrupt_ring_detection == False and self.doorbell_ringing() == True:
+            self.process_event('Ring', time.monotonic())
+        if self.next_metrics_publish != None and time.monotonic() >= self.next_metrics_publish:
+            self.publish_metrics()
+            self.next_metrics_publish += self.metrics_publish_period
+
     def run(self):
-        self.led_cycle_duration = 0.05
-        self.led_cycle_count = 20
-        self.flash_leds = TwoLedFlash(self.led_cycle_duration, self.led_cycle_count)
-        self.flash_leds_thread = Thread(target=self.flash_leds.run)
-        self.flash_leds_thread.start()
+        self.leds = LedPatternDriver(self.gpio, self.pins['Manual LED Off'], self.pins['Auto LED Off'])
+        self.leds_thread = Thread(target=self.leds.run, name='leds')
+        self.leds_thread.start()
         self.print_status("Northcliff Doorbell Monitor Started on ")
-        if self.linphone_in_manual_mode == True:
-            self.start_linphone()
-            time.sleep(5)
-            print("Linphone Test Call on Startup")
-            subprocess.call(['linphonecsh dial ' + self.manual_mode_call_sip_address], shell=True)
-            time.sleep(25)
-            print("Terminating Linphone Test Call")
-            subprocess.call(["linphonecsh generic 'terminate'"], shell=True) # Terminate linphone call
-            self.stop_linphone()
-        else:
-            self.capture_video() # Capture picture on startup
-        if self.ask_for_auto_time_input == True:
-            self.input_auto_mode_times()
-        if self.disable_weekend == True:
-            print ("Active Auto Mode Start at " + str(self.active_auto_start) + ":00 Hours, Active Auto Mode Finish at " + str(self.active_auto_finish)
-                   + ":00 Hours, Auto Mode Disabled on Weekends")
+        self.last_clip_job = self.clip_executor.submit(self.capture_retention.prune)
+        if self.fast_start == True: # The startup tasks run in the background while the doorbell is monitored
+            startup_executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix='startup')
+            camera_warm_up = startup_executor.submit(self.warm_up_camera)
+            startup_executor.submit(self.load_messages)
+            if self.linphone_in_manual_mode == True:
+                startup_executor.submit(self.start_sip_self_test, camera_warm_up)
+            startup_executor.shutdown(wait=False)
+            if self.ask_for_auto_time_input == True:
+                Thread(target=self.input_auto_mode_times_in_background, name='auto_time_input', daemon=True).start()
         else:
-            print ("Active Auto Mode Start at " + str(self.active_auto_start) + ":00 Hours, Active Auto Mode Finish at " + str(self.active_auto_finish)
-                   + ":00 Hours, Auto Mode Enabled on Weekends")
-        self.previous_auto_possible = True
+            self.warm_up_camera()
+            if self.linphone_in_manual_mode == True:
+                self.start_sip_self_test()
+            if self.ask_for_auto_time_input == True:
+                self.input_auto_mode_times()
+        print(self.auto_schedule.describe())
+        self.current_auto_possible = self.auto_possible()
+        self.next_schedule_change = self.auto_schedule.next_transition()
+        if self.metrics_publish_period != None:
+            self.next_metrics_publish = time.monotonic() + self.metrics_publish_period
         self.idle_mode_startup()
-        self.auto_mode_attempt = False
         if self.auto_on_startup == True:
-            self.process_auto_button(self.auto_button)
-            self.auto_mode_startup()
+            self.process_event('Auto Button')
+        if self.interrupt_ring_detection == True:
+            print("Interrupt Ring Detection Mode")
+        else:
+            print("Polling Ring Detection Mode")
+        self.supervisor.add_component('Main Loop', self.check_main_loop, self.main_loop_stalled)
+        self.supervisor.add_component('Notifier', self.notifier.is_alive, self.notifier.start)
+        self.supervisor.add_component('Commands', self.command_dispatcher.is_alive, self.command_dispatcher.start)
+        self.supervisor.add_component('Camera', self.camera.is_alive, self.camera.start)
+        self.supervisor.add_component('LEDs', lambda: self.leds_thread.is_alive(), self.restart_leds)
+        if self.metrics.event_log_file != None:
+            self.supervisor.add_component('Event Log', lambda: self.metrics.log_thread.is_alive(), self.metrics.start)
+        self.main_loop_checked = time.monotonic()
+        self.supervisor.start()
+        self.component_ready('Ring Detection')
+        self.component_ready('Door Control')
         try:
             while True: # Run Doorbell Monitor in continuous loop
-                self.current_auto_possible = self.auto_possible()
-                if self.auto_mode_enabled == True and self.current_auto_possible == True:
-                    if self.previous_auto_possible == False or self.auto_mode_attempt == True:
-                        self.auto_mode_attempt = False
-                        self.auto_mode_startup()
-                    self.auto_mode()
-                elif self.auto_mode_enabled == True and self.current_auto_possible == False:
-                    if self.previous_auto_possible == True or self.auto_mode_attempt == True:
-                        self.auto_mode_attempt = False
-                        self.manual_mode_startup(normal_manual_flash = False) # Change LED Flashing in manual_mode_startup to indicate that auto has been disabled due to out of hours or door opening
-                    self.manual_mode()
-                elif self.manual_mode_enabled == True:
-                    self.manual_mode()
+                try:
+                    event, event_args = self.event_queue.get(timeout = self.loop_timeout())
+                except queue.Empty:
+                    self.process_loop_period()
+                    continue
+                if event == 'Stop':
+                    break
+                elif event == 'Watchdog':
+                    self.main_loop_checked = time.monotonic()
+                elif event == 'Entry Door Change':
+                    self.process_door_status_change(*event_args)
+                elif event == 'Schedule Change': # The auto answer times have been entered in fast start mode
+                    print(self.auto_schedule.describe())
+                    self.update_auto_possible()
                 else:
-                    self.idle_mode()
-                self.previous_auto_possible = self.current_auto_possible
-                self.process_home_manager_heartbeat()
-                time.sleep(0.1)
+                    self.process_event(event, *event_args)
+            self.shutdown_cleanup()
 	            
         except KeyboardInterrupt: # Shutdown on ctrl C
             # Shutdown main program
             self.shutdown_cleanup()
+
+    def stop(self): # Stops the main loop from another thread, e.g. a benchmark or test harness
+        self.post_event('Stop')
+
+class DoorbellStations(object): # The class for running several door stations in one process. The stations share one mqtt connection, Pushover notifier,
+    # set of capture workers, event index and metrics endpoint. Each station has its own pins, topics, schedule, camera and main loop
+    def __init__(self, station_settings, common_settings, mqtt_client_id = 'doorbell_stations', services = None):
+        all_monitor_settings = []
+        event_log_files = []
+        for settings in station_settings: # A station's settings override the common settings. The shared settings are only used by the services
+            monitor_settings = dict(common_settings)
+            monitor_settings.update(settings)
+            event_log_file = monitor_settings.get('event_log_file')
+            if event_log_file != None and 'event_log_file' not in settings: # The common event log is split by station, because the event log threads
+                # would lose lines if they appended to and rotated the same file
+                log_root, log_extension = os.path.splitext(event_log_file)
+                event_log_file = log_root + '_' + monitor_settings.get('topic_prefix', 'Doorbell') + log_extension
+                monitor_settings['event_log_file'] = event_log_file
+            if event_log_file != None and event_log_file in event_log_files:
+                raise ValueError('Door stations need their own event_log_file. ' + event_log_file + ' is used by more than one station')
+            event_log_files.append(event_log_file)
+            all_monitor_settings.append(monitor_settings)
+        if services == None: # Set up once the settings have been checked, so that a settings error doesn't leave the service threads running
+            services = DoorbellServices.from_settings(common_settings, mqtt_client_id = mqtt_client_id)
+        self.services = services
+        self.monitors = [NorthcliffDoorbellMonitor(services = self.services, **monitor_settings) for monitor_settings in all_monitor_settings]
+        self.station_threads = []
+
+    def run(self):
+        self.services.start(blocking_connect = all(monitor.fast_start == True for monitor in self.monitors) == False)
+        for monitor in self.monitors:
+            station_thread = Thread(target=monitor.run, name=monitor.station_name)
+            station_thread.start()
+            self.station_threads.append(station_thread)
+        try:
+            for station_thread in self.station_threads:
+                while station_thread.is_alive() == True:
+                    station_thread.join(1)
+        except KeyboardInterrupt: # Shutdown on ctrl C
+            self.stop()
+            for station_thread in self.station_threads:
+                station_thread.join()
+        self.services.terminate()
+
+    def stop(self): # Stops the stations from another thread, e.g. a benchmark or test harness
+        for monitor in self.monitors:
+            monitor.stop()
             
 if __name__ == '__main__': # This is where to overall code kicks off
-    monitor = NorthcliffDoorbellMonitor(pushover_in_manual_mode = True, full_video = False, ask_for_auto_time_input = False, active_auto_start = 7,
-                                        active_auto_finish = 19, disable_weekend = True, manual_mode_call_sip_address = "<Your SIP Address Here>",
-                                        pushover_token = "<Your Pushover Token Here>", pushover_user = "<Your Pushover User Here>",
-                                        linphone_debug_log_file = "<Your linphone debug log file location here>", auto_message_file = "<Your auto message file location here>",
-                                        auto_video_capture_directory = "<Your video capture directory location here>", linphone_config_file = "<Your linphone config file location here>",
-                                        auto_on_startup = True, linphone_in_manual_mode = True, heartbeat_enabled = True)
-    monitor.run()
+    settings = dict(pushover_in_manual_mode = True, full_video = False, ask_for_auto_time_input = False, active_auto_start = 7,
+                    active_auto_finish = 19, disable_weekend = True, manual_mode_call_sip_address = "<Your SIP Address Here>",
+                    pushover_token = "<Your Pushover Token Here>", pushover_user = "<Your Pushover User Here>",
+                    linphone_debug_log_file = "<Your linphone debug log file location here>", auto_message_file = "<Your auto message file location here>",
+                    auto_video_capture_directory = "<Your video capture directory location here>", linphone_config_file = "<Your linphone config file location here>",
+                    auto_on_startup = True, linphone_in_manual_mode = True, heartbeat_enabled = True, interrupt_ring_detection = True,
+                    camera_backend = 'Fswebcam', clip_recording = False, capture_retention_megabytes = 2000, capture_retention_days = 90,
+                    auto_windows = None, auto_holidays = [], mqtt_qos = 1, status_coalesce_period = 0.2,
+                    event_log_file = "<Your event log file location here>", metrics_port = 9101, metrics_address = '127.0.0.1',
+                    metrics_publish_period = 60, event_index_file = "<Your event index database location here>", attachment_max_dimension = 1024,
+                    attachment_max_kilobytes = 150, audio_backend = 'Alsa', audio_device = 'front:CARD=Device,DEV=0', fast_start = True,
+                    audio_messages = None, heartbeat_interval = 300, heartbeat_ack_timeout = 150, heartbeat_reboot_timeout = 1800,
+                    mqtt_reconnect_max_delay = 30, main_loop_stall_timeout = 120) # e.g. auto_windows = {0: [('07:30', '12:00'), ('13:00', '18:30')], ...}, auto_holidays = ['2026-12-25'],
+                    # audio_messages = [{'file': '<Your after hours message location here>', 'modes': ['Auto'], 'windows': {5: [('17:00', '07:00')], ...}}]
+    stations = None # For several door stations in one process, each overriding the settings above, e.g. [{'station_name': 'Front Door', 'topic_prefix': 'FrontDoorbell'},
+    # {'station_name': 'Side Door', 'topic_prefix': 'SideDoorbell', 'pins': {'Manual Button': 5, 'Auto Button': 6, 'Doorbell Not Ringing': 13, 'Open Door': 19,
+    # 'Manual LED Off': 20, 'Auto LED Off': 26}, 'camera_device': 1, 'auto_video_capture_directory': '<Your side door capture directory here>',
+    # 'event_log_file': '<Your side door event log file here>', 'auto_windows': {...}}]
+    if stations == None:
+        monitor = NorthcliffDoorbellMonitor(**settings)
+        monitor.run()
+    else:
+        DoorbellStations(stations, settings).run()
         
 
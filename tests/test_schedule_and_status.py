@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# Tests for the auto answer schedule, driven by an injected clock, and the status publisher's change detection and coalescing.
+# Run with python3 -m unittest discover tests, or pytest
+import os
+import sys
+import unittest
+from datetime import datetime, date
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Northcliff_Doorbell_Monitor_Gen import AutoAnswerSchedule, StatusPublisher
+
+MONDAY = date(2026, 10, 19)
+
+def at(day_offset, hour, minute = 0): # Days after Monday 19 October 2026
+    return datetime(MONDAY.year, MONDAY.month, MONDAY.day + day_offset, hour, minute)
+
+class AutoAnswerScheduleTest(unittest.TestCase):
+    def test_window(self):
+        schedule = AutoAnswerSchedule({0: [('07:30', '12:00')]})
+        self.assertEqual(schedule.is_active(at(0, 7, 29)), False)
+        self.assertEqual(schedule.is_active(at(0, 7, 30)), True)
+        self.assertEqual(schedule.is_active(at(0, 11, 59)), True)
+        self.assertEqual(schedule.is_active(at(0, 12, 0)), False)
+        self.assertEqual(schedule.is_active(at(1, 8, 0)), False)
+
+    def test_injected_clock(self):
+        now = [at(0, 6, 0)]
+        schedule = AutoAnswerSchedule({0: [('07:00', '19:00')]}, clock = lambda: now[0])
+        self.assertEqual(schedule.is_active(), False)
+        self.assertEqual(schedule.next_transition(), at(0, 7, 0))
+        now[0] = at(0, 7, 0)
+        self.assertEqual(schedule.is_active(), True)
+        self.assertEqual(schedule.next_transition(), at(0, 19, 0))
+
+    def test_overnight_window(self):
+        schedule = AutoAnswerSchedule({4: [('22:00', '02:00')]}) # Friday night
+        self.assertEqual(schedule.is_active(at(4, 21, 59)), False)
+        self.assertEqual(schedule.is_active(at(4, 23, 0)), True)
+        self.assertEqual(schedule.is_active(at(5, 1, 59)), True)
+        self.assertEqual(schedule.is_active(at(5, 2, 0)), False)
+        self.assertEqual(schedule.next_transition(at(4, 23, 0)), at(5, 2, 0))
+
+    def test_sunday_to_monday_wrap(self):
+        schedule = AutoAnswerSchedule({6: [('23:00', '01:00')]})
+        self.assertEqual(schedule.is_active(at(0, 0, 30)), True)
+        self.assertEqual(schedule.is_active(at(0, 1, 0)), False)
+        self.assertEqual(schedule.is_active(at(6, 22, 59)), False)
+        self.assertEqual(schedule.is_active(at(6, 23, 30)), True)
+        self.assertEqual(schedule.next_transition(at(6, 22, 0)), at(6, 23, 0))
+        self.assertEqual(schedule.next_transition(at(0, 0, 30)), at(0, 1, 0))
+
+    def test_overlapping_and_adjacent_windows_are_merged(self):
+        schedule = AutoAnswerSchedule({0: [('08:00', '12:00'), ('11:00', '14:00'), ('14:00', '15:00')]})
+        self.assertEqual(schedule.transition_minutes, [8 * 60, 15 * 60])
+        self.assertEqual(schedule.next_transition(at(0, 9, 0)), at(0, 15, 0))
+
+    def test_holiday(self):
+        windows = {weekday: [('07:00', '19:00')] for weekday in range(7)}
+        schedule = AutoAnswerSchedule(windows, ['2026-10-21'])
+        self.assertEqual(schedule.is_active(at(2, 12, 0)), False)
+        self.assertEqual(schedule.is_active(at(3, 12, 0)), True)
+        self.assertEqual(schedule.next_transition(at(2, 12, 0)), at(3, 7, 0))
+
+    def test_holiday_interrupting_an_all_day_schedule(self):
+        windows = {weekday: [('00:00', '00:00')] for weekday in range(7)} # Always active
+        schedule = AutoAnswerSchedule(windows, [date(2026, 10, 22)])
+        self.assertEqual(schedule.next_transition(at(0, 12, 0)), at(3, 0, 0))
+        self.assertEqual(schedule.next_transition(at(3, 12, 0)), at(4, 0, 0))
+
+    def test_holiday_beyond_the_next_week(self):
+        windows = {weekday: [('00:00', '00:00')] for weekday in range(7)}
+        schedule = AutoAnswerSchedule(windows, ['2026-12-25'])
+        self.assertEqual(schedule.next_transition(at(0, 12, 0)), datetime(2026, 12, 25))
+
+    def test_never_changes(self):
+        self.assertEqual(AutoAnswerSchedule({}).next_transition(at(0, 12, 0)), None)
+        always = AutoAnswerSchedule({weekday: [('00:00', '00:00')] for weekday in range(7)})
+        self.assertEqual(always.is_active(at(6, 23, 59)), True)
+        self.assertEqual(always.next_transition(at(0, 12, 0)), None)
+
+    def test_hourly_windows(self):
+        schedule = AutoAnswerSchedule(AutoAnswerSchedule.hourly_windows(7, 19, True))
+        self.assertEqual(schedule.is_active(at(4, 18, 59)), True)
+        self.assertEqual(schedule.is_active(at(4, 19, 0)), False)
+        self.assertEqual(schedule.is_active(at(5, 12, 0)), False) # Weekend disabled
+        self.assertEqual(schedule.next_transition(at(4, 19, 0)), at(7, 7, 0))
+
+class RecordingClient(object): # Records the messages published through it
+    def __init__(self):
+        self.messages = [] # (topic, payload, retain)
+
+    def publish(self, topic, payload, qos = 0, retain = False):
+        self.messages.append((topic, payload, retain))
+
+class StatusPublisherTest(unittest.TestCase):
+    def setUp(self):
+        self.client = RecordingClient()
+        self.publisher = StatusPublisher(self.client, 'DoorbellStatus', coalesce_period = 60) # Flushed by the tests
+
+    def test_unchanged_status_is_not_published(self):
+        self.publisher.publish_status('A')
+        self.publisher.flush()
+        self.publisher.publish_status('A')
+        self.publisher.flush()
+        self.assertEqual(self.client.messages, [('DoorbellStatus', 'A', True)])
+        self.assertEqual(self.publisher.publish_counts['Unchanged'], 1)
+
+    def test_burst_is_coalesced_into_the_last_status(self):
+        for status in ('A', 'B', 'C'):
+            self.publisher.publish_status(status)
+        self.publisher.flush()
+        self.assertEqual(self.client.messages, [('DoorbellStatus', 'C', True)])
+        self.assertEqual(self.publisher.publish_counts['Coalesced'], 2)
+
+    def test_burst_ending_where_it_started_is_not_published(self):
+        self.publisher.publish_status('A')
+        self.publisher.flush()
+        self.publisher.publish_status('B')
+        self.publisher.publish_status('A')
+        self.publisher.flush()
+        self.assertEqual(self.client.messages, [('DoorbellStatus', 'A', True)])
+
+    def test_force_publishes_immediately(self):
+        self.publisher.publish_status('A')
+        self.publisher.flush()
+        self.publisher.publish_status('A', force = True)
+        self.assertEqual(self.client.messages, [('DoorbellStatus', 'A', True), ('DoorbellStatus', 'A', True)])
+
+    def test_event_follows_the_pending_status(self):
+        self.publisher.publish_status('A')
+        self.publisher.publish_event('{"service": "Heartbeat"}')
+        self.assertEqual(self.client.messages, [('DoorbellStatus', 'A', True), ('DoorbellStatus', '{"service": "Heartbeat"}', False)])
+
+    def test_status_after_a_ringing_pulse_is_published(self):
+        idle = '{"service": "Status Update", "Ringing": false}'
+        self.publisher.publish_status(idle)
+        self.publisher.flush()
+        self.publisher.publish_event('{"service": "Status Update", "Ringing": true}')
+        self.publisher.publish_status(idle)
+        self.publisher.flush()
+        self.assertEqual([payload for topic, payload, retain in self.client.messages][-1], idle)
+        self.assertEqual(len(self.client.messages), 3)
+
+    def test_republish(self):
+        self.publisher.publish_status('A')
+        self.publisher.flush()
+        self.publisher.republish()
+        self.assertEqual(self.client.messages, [('DoorbellStatus', 'A', True), ('DoorbellStatus', 'A', True)])
+
+if __name__ == '__main__':
+    unittest.main()